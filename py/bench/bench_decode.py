@@ -0,0 +1,44 @@
+import os
+import time
+import tracemalloc
+
+# keep the benchmark from reading or filling the on-disk cache
+os.environ.setdefault("BROWSER_CACHE_PATH", "")
+
+import server
+from url import URL
+
+def measure(url, stream):
+    # peak traced memory and wall time for one fetch; when streaming the body
+    # goes to a consumer that only counts characters
+    received = [0]
+    def count(text):
+        received[0] += len(text)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if stream:
+        URL(url).request(count)
+    else:
+        received[0] = len(URL(url).request()[0])
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return received[0], elapsed, peak
+
+if __name__ == "__main__":
+    base = server.start()
+    size = 8 * 1024 * 1024
+    for encoding in ("identity", "gzip", "deflate"):
+        for chunked in (False, True):
+            url = "{}/page?size={}&encoding={}&chunked={}&chunk=4096".format(
+                base, size, encoding, int(chunked))
+            server.body(size, encoding)
+            URL(url).request(lambda text: None)
+
+            for stream in (False, True):
+                chars, elapsed, peak = measure(url, stream)
+                print("{:>8} {:>7} {:>9}: {:6.1f} MB/s  peak {:6.1f} MB ({:.2f}x body)".format(
+                    encoding, "chunked" if chunked else "length",
+                    "streamed" if stream else "buffered",
+                    chars / elapsed / 1e6, peak / 1e6, peak / chars))
@@ -0,0 +1,54 @@
+import contextlib
+import io
+import os
+import time
+
+# layout needs no display with the headless font backend
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+
+from corpus import nested
+from html import HTMLParser, print_tree
+from layout import DocumentLayout, paint_tree, FONT_TABLE
+from draw import DisplayList
+
+DEPTHS = [25_000, 50_000, 100_000]
+# print_tree's output grows with the square of the depth (one dot per level),
+# so it only gets a depth that would have overflowed the old recursive version
+PRINT_DEPTH = 5_000
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def measure(body, width = 782):
+    # every phase walks the whole tree; none of them may recurse per level
+    nodes, parse_time = timed(lambda: HTMLParser(body).parse())
+    document = DocumentLayout(nodes, 0, 0, width, 600)
+    _, layout_time = timed(document.layout)
+    display_list = DisplayList(FONT_TABLE)
+    _, paint_time = timed(lambda: paint_tree(document, display_list))
+    return parse_time, layout_time, paint_time
+
+def measure_print(body):
+    nodes = HTMLParser(body).parse()
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        _, dump_time = timed(lambda: print_tree(nodes))
+    return dump_time, len(out.getvalue())
+
+if __name__ == "__main__":
+    # time per level should stay flat as the depth doubles
+    for tag in ("div", "b"):
+        for depth in DEPTHS:
+            times = measure(nested(depth, tag))
+            print("<{}> x {:>7}: parse {:6.3f}s  layout {:6.3f}s  paint {:6.3f}s  ({:.2f} us/level)".format(
+                tag, depth, *times, sum(times) / depth * 1e6))
+        dump_time, size = measure_print(nested(PRINT_DEPTH, tag))
+        print("<{}> x {:>7}: print_tree {:6.3f}s  ({:.1f} MB of output)".format(
+            tag, PRINT_DEPTH, dump_time, size / 1e6))
+    # the same for <div>s opened behind a <button>, which each one's check
+    # for an open <p> to close must not walk back past
+    for depth in DEPTHS:
+        times = measure("<p><button>" + "<div>x" * depth)
+        print("<p><button><div> x {:>7}: parse {:6.3f}s  layout {:6.3f}s  paint {:6.3f}s  ({:.2f} us/level)".format(
+            depth, *times, sum(times) / depth * 1e6))
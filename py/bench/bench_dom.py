@@ -0,0 +1,57 @@
+import gc
+import sys
+import time
+import tracemalloc
+
+from corpus import document, page, SIZES
+from html import HTMLParser, Text
+
+def count(tree):
+    # (elements, text nodes) in the tree
+    elements = texts = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Text):
+            texts += 1
+        else:
+            elements += 1
+        stack.extend(node.children)
+    return elements, texts
+
+def text_bytes(tree):
+    # the strings the page's text is made of, which any DOM has to hold
+    total = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Text):
+            total += sys.getsizeof(node.text)
+        stack.extend(node.children)
+    return total
+
+def measure(body):
+    # bytes still allocated once the parser is gone, i.e. what the tree costs
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = HTMLParser(body).parse()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return tree, size
+
+if __name__ == "__main__":
+    pages = [("small", page("small")), ("wiki", page("wiki")),
+             ("large", document(SIZES["large"]))]
+    for name, body in pages:
+        tree, size = measure(body)
+        elements, texts = count(tree)
+        nodes = elements + texts
+        structure = size - text_bytes(tree)
+        start = time.perf_counter()
+        HTMLParser(body).parse()
+        parse_time = time.perf_counter() - start
+        print("{:>6}: {:7d} nodes ({} elements)  {:6.1f} bytes/node, {:6.1f} without text"
+              "  ({:.2f} MB)  parse {:.3f}s".format(
+                  name, nodes, elements, size / nodes, structure / nodes, size / 1e6, parse_time))
@@ -0,0 +1,63 @@
+import os
+import time
+
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+
+from corpus import document, prose, SIZES
+from html import HTMLParser
+from layout import DocumentLayout, paint_tree, FONT_TABLE
+from draw import DisplayList, DisplayIndex
+
+WIDTH, HEIGHT = 782, 600
+# how far below the viewport lazy layout reaches, as in the browser
+OVERSCAN = HEIGHT
+
+def first_frame(tree, bottom):
+    # layout, paint and index up to the first frame; bottom None is a full layout
+    start = time.perf_counter()
+    document_layout = DocumentLayout(tree, 0, 0, WIDTH, HEIGHT)
+    document_layout.layout(bottom)
+    display_list = DisplayList(FONT_TABLE)
+    paint_tree(document_layout, display_list)
+    index = DisplayIndex(display_list)
+    return document_layout, display_list, index, time.perf_counter() - start
+
+def scroll_through(document_layout, display_list, index):
+    # scroll a screen at a time to the end, as the browser's draw() does,
+    # correcting the scroll position for each estimate replaced
+    scroll = 0
+    shifted = 0
+    while not document_layout.complete:
+        scroll += HEIGHT
+        blocks, shift = document_layout.extend(scroll + HEIGHT + OVERSCAN, scroll)
+        scroll += shift
+        shifted += abs(shift)
+        for block in blocks:
+            paint_tree(block, display_list)
+        index.add()
+    return shifted
+
+def rows(display_list):
+    return sorted(zip(display_list.kinds, display_list.lefts, display_list.tops,
+                      display_list.rights, display_list.bottoms, display_list.font_ids,
+                      display_list.payloads))
+
+if __name__ == "__main__":
+    pages = [(name, document(size)) for name, size in SIZES.items()]
+    pages.append(("prose", prose(SIZES["large"])))
+    for name, body in pages:
+        tree = HTMLParser(body).parse()
+        full, full_list, _, full_time = first_frame(tree, None)
+
+        tree = HTMLParser(body).parse()
+        lazy, lazy_list, lazy_index, lazy_time = first_frame(tree, HEIGHT + OVERSCAN)
+        laid_out, blocks = lazy.laid_out, len(lazy.container.children)
+        estimated = lazy.height
+        shifted = scroll_through(lazy, lazy_list, lazy_index)
+
+        same = rows(lazy_list) == rows(full_list) and lazy.height == full.height
+        print("{:>6}: first frame full {:7.3f}s  lazy {:7.4f}s ({:6.1f}x), {:4d} of {:5d} blocks;"
+              "  estimated height {:8.0f} vs {:8.0f} ({:+.1%}), scroll corrected by {:.0f}px{}".format(
+                  name, full_time, lazy_time, full_time / lazy_time, laid_out, blocks,
+                  estimated, full.height, estimated / full.height - 1, shifted,
+                  "" if same else "  LAYOUT DIFFERS"))
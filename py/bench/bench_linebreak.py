@@ -0,0 +1,84 @@
+import os
+import time
+
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+
+from corpus import document, prose, SIZES
+from constants import VSTEP
+from html import HTMLParser
+from layout import DocumentLayout, LINE_BREAK, PARAGRAPH_BREAK
+from draw import DisplayList
+
+WIDTHS = (782, 500, 300)
+REPEAT = 3
+
+def greedy(block):
+    # the word-at-a-time algorithm break_run replaces, for comparison: place
+    # each word after the last, starting a new line when it won't fit
+    display_list = DisplayList(None)
+    cursor_y = 0
+    line = []
+
+    def flush():
+        nonlocal cursor_y, line
+        if not line: return
+        baseline = cursor_y + 1.25 * max([ascent for _, _, _, ascent, _, _ in line])
+        for rel_x, word, font_id, ascent, descent, linespace in line:
+            display_list.text(block.x + rel_x, block.y + baseline - ascent, word, font_id, linespace)
+        cursor_y = baseline + 1.25 * max([descent for _, _, _, _, descent, _ in line])
+        line = []
+
+    for item in block.items:
+        if item is LINE_BREAK:
+            flush()
+        elif item is PARAGRAPH_BREAK:
+            flush()
+            cursor_y += VSTEP
+        else:
+            cursor_x = 0
+            for i, word in enumerate(item.words):
+                w = item.widths[i]
+                if cursor_x + w > block.width:
+                    flush()
+                    cursor_x = 0
+                line.append((cursor_x, word, item.font_ids[i], item.ascents[i],
+                             item.descents[i], item.linespaces[i]))
+                # the advance is the width plus the font's space, summed once
+                cursor_x += item.advances[i]
+            flush()
+    return display_list, cursor_y
+
+def columns(display_list):
+    return (display_list.lefts, display_list.tops, display_list.bottoms,
+            display_list.font_ids, display_list.payloads)
+
+if __name__ == "__main__":
+    pages = [("prose", prose(SIZES["large"])), ("wiki", document(SIZES["wiki"])),
+             ("large", document(SIZES["large"]))]
+    for name, body in pages:
+        document_layout = DocumentLayout(HTMLParser(body).parse(), 0, 0, WIDTHS[0], 600)
+        document_layout.layout()
+        blocks = document_layout.inline_blocks()
+        words = sum(len(item) for block in blocks for item in block.items
+                    if item is not LINE_BREAK and item is not PARAGRAPH_BREAK)
+        for width in WIDTHS:
+            document_layout.x2 = width
+            document_layout.layout()
+
+            bulk = reference = float("inf")
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                for block in blocks:
+                    block.break_lines()
+                bulk = min(bulk, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                expected = [greedy(block) for block in blocks]
+                reference = min(reference, time.perf_counter() - start)
+
+            same = all(columns(block.display_list) == columns(display_list) and
+                       block.cursor_y == height
+                       for block, (display_list, height) in zip(blocks, expected))
+            print("{:>6} ({:6d} words / {:5d} blocks), width {}: greedy {:6.3f}s  runs {:6.3f}s"
+                  "  ({:.2f}x){}".format(name, words, len(blocks), width, reference, bulk,
+                                         reference / bulk, "" if same else "  POSITIONS DIFFER"))
@@ -0,0 +1,37 @@
+import os
+import time
+import tracemalloc
+
+# layout needs no display with the headless font backend
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+
+from corpus import document, SIZES
+from html import HTMLParser
+from layout import DocumentLayout, paint_tree, FONT_TABLE
+from draw import DisplayList
+
+def measure(body, width = 782):
+    # wall time and traced memory for layout and for paint of one document
+    nodes = HTMLParser(body).parse()
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    document = DocumentLayout(nodes, 0, 0, width, 600)
+    document.layout()
+    layout_time = time.perf_counter() - start
+    layout_bytes = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    display_list = DisplayList(FONT_TABLE)
+    paint_tree(document, display_list)
+    paint_time = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(display_list), layout_time, layout_bytes, paint_time, current - layout_bytes, peak
+
+if __name__ == "__main__":
+    for name, size in SIZES.items():
+        rows, layout_time, layout_bytes, paint_time, paint_bytes, peak = measure(document(size))
+        print("{:>6}: {:7d} rows  layout {:6.3f}s {:6.1f} MB  paint {:6.3f}s {:6.1f} MB ({:.0f} B/row)  peak {:6.1f} MB".format(
+            name, rows, layout_time, layout_bytes / 1e6, paint_time, paint_bytes / 1e6,
+            paint_bytes / max(rows, 1), peak / 1e6))
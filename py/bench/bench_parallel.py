@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+
+# worker processes measure with the headless backend, so we must too
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+
+from corpus import document, SIZES
+from html import HTMLParser
+from layout import DocumentLayout, paint_tree, FONT_TABLE
+from draw import DisplayList
+from parallel import LayoutPool
+
+WIDTH = 782
+
+def rows(doc):
+    display_list = DisplayList(FONT_TABLE)
+    paint_tree(doc, display_list)
+    return (display_list.kinds, display_list.lefts, display_list.tops, display_list.rights,
+            display_list.bottoms, display_list.font_ids, display_list.payloads)
+
+def serial(nodes):
+    doc = DocumentLayout(nodes, 0, 0, WIDTH, 600)
+    start = time.perf_counter()
+    doc.layout()
+    return doc, time.perf_counter() - start
+
+def parallel(nodes, pool):
+    doc = DocumentLayout(nodes, 0, 0, WIDTH, 600)
+    start = time.perf_counter()
+    pool.layout(doc)
+    return doc, time.perf_counter() - start
+
+if __name__ == "__main__":
+    workers = [int(arg) for arg in sys.argv[1:]] or [1, 2, 4, os.cpu_count()]
+    print("{} cpus".format(os.cpu_count()))
+    for name in ("wiki", "large"):
+        nodes = HTMLParser(document(SIZES[name])).parse()
+        expected, serial_time = serial(nodes)
+        expected = rows(expected)
+        print("{:>6}: serial {:6.3f}s".format(name, serial_time))
+        for n in sorted(set(workers)):
+            with LayoutPool(n) as pool:
+                # the first run also pays for starting the workers
+                parallel(nodes, pool)
+                doc, parallel_time = parallel(nodes, pool)
+            same = rows(doc) == expected
+            print("{:>6}: {:2d} workers {:6.3f}s  ({:.2f}x){}".format(
+                name, n, parallel_time, serial_time / parallel_time,
+                "" if same else "  OUTPUT DIFFERS"))
@@ -0,0 +1,131 @@
+import time
+
+from corpus import document, entity_dense, SIZES
+from html import HTMLParser, Text, char_ref
+
+def parse_chars(body):
+    # reference tokenizer -- walks the body one character at a time and feeds
+    # the same tree builder, for checking the bulk tokenizer against
+    parser = HTMLParser()
+    in_tag = False
+    text = ""
+    buf = ""
+    pos = 0
+    end = len(body)
+    while pos < end:
+        while body.startswith("<!--", pos):
+            close = body.find("-->", pos + 2)
+            pos = end if close < 0 else close + 3
+        if pos >= end:
+            break
+
+        c = body[pos]
+        if not in_tag:
+            if c == "<":
+                in_tag = True
+                parser.add_text(text)
+                text = ""
+            elif c == "&":
+                value, after = char_ref(body, pos, True)
+                text += value
+                # the step below moves past the reference
+                pos = after - 1
+            else:
+                text += c
+        elif c == ">":
+            in_tag = False
+            parser.add_tag(buf)
+            buf = ""
+        else:
+            buf += c
+        pos += 1
+
+    if not in_tag and text:
+        parser.add_text(text)
+    return parser.finish()
+
+def same_tree(a, b):
+    # structural comparison of two parsed trees
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, Text):
+            if a.text != b.text:
+                return False
+        elif a.tag != b.tag or a.attributes != b.attributes:
+            return False
+        if len(a.children) != len(b.children):
+            return False
+        stack.extend(zip(a.children, b.children))
+    return True
+
+PARITY_CASES = [
+    "",
+    "plain text",
+    "<p>hello <b>world</b></p>",
+    "a &lt; b &amp;&amp; c &gt; d",
+    "<!-- comment -->text<!---->more<!-->x",
+    "<!--a--><!--b-->after",
+    "<p>unterminated <!-- comment",
+    "<p>unterminated &entity",
+    "<a href=x<!-- > -->>link</a>",
+    "before &am<!-- ; -->p; after",
+    "<title>t</title><meta charset=utf-8><p>body",
+    "<div><p>one<p>two</div>",
+    "&#123;&#x1F600;&#0;&#x110000;&#128; &copy 2024 &notin; &notit; &fjlig;",
+    "stray & and && and &; and &# and &#x; and AT&T",
+    "&CounterClockwiseContourIntegral;&CounterClockwiseContourIntegralX;",
+    "ends with &am",
+    "&#99999999999999999999999; &#x00000000041; &#000000000000000000065;",
+    "<p>a<button><div>b<p>c</button><div>d",
+    "<ul><li>a<ol><li>b<li>c</ol><li>d<p>e<li>f</ul>",
+    "<table><tr><td>a<table><tr><td>b<tr><td>c</table><td>d<tr><th>e</table>",
+    "<dl><dt>a<dd>b<p>c<dt>d</dl>",
+]
+
+def feed_chunks(body, size):
+    parser = HTMLParser()
+    for i in range(0, len(body), size):
+        parser.feed(body[i:i + size])
+    return parser.close()
+
+def parity():
+    cases = PARITY_CASES + [document(SIZES["small"], seed) for seed in range(20)]
+    cases += [entity_dense(SIZES["small"], seed) for seed in range(5)]
+    for body in cases:
+        expected = parse_chars(body)
+        if not same_tree(HTMLParser(body).parse(), expected):
+            raise AssertionError("tokenizers disagree on {!r}".format(body[:80]))
+        for size in (1, 3, 17, 512):
+            if not same_tree(feed_chunks(body, size), expected):
+                raise AssertionError("feed({}) disagrees on {!r}".format(size, body[:80]))
+    return len(cases)
+
+def throughput(body, parse, repeat = 3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(body)
+        best = min(best, time.perf_counter() - start)
+    return len(body.encode("utf-8")) / best / 1e6
+
+if __name__ == "__main__":
+    print("parity: {} documents identical".format(parity()))
+    pages = [(name, document(size)) for name, size in SIZES.items()]
+    pages.append(("entity", entity_dense(SIZES["wiki"])))
+    # one long comment, which feed() must not rescan for every chunk
+    pages.append(("comment", "<p>a<!--" + "x" * SIZES["large"] + "-->b"))
+    # a <p> behind a scope boundary, which each <div> must not walk back to
+    pages.append(("scoped", "<p><button>" + "<div>x" * (SIZES["wiki"] // 6)))
+    for name, body in pages:
+        fast = throughput(body, lambda body: HTMLParser(body).parse())
+        line = "{:>6}: parse {:8.2f} MB/s".format(name, fast)
+        start = time.perf_counter()
+        feed_chunks(body, 16 * 1024)
+        line += "  feed {:8.2f} MB/s".format(len(body.encode("utf-8")) / (time.perf_counter() - start) / 1e6)
+        if len(body) <= SIZES["wiki"] * 1.1:
+            slow = throughput(body, parse_chars)
+            line += "  parse_chars {:6.2f} MB/s  ({:.1f}x)".format(slow, fast / slow)
+        print(line)
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import time
+
+# snapshots depend on the font backend, so measure with the headless one
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+os.environ.setdefault("BROWSER_CACHE_PATH", "")
+
+from corpus import document, page, SIZES
+from html import HTMLParser
+from layout import DocumentLayout, paint_tree, FONT_TABLE
+from draw import DisplayList, DisplayIndex
+from snapshot import SnapshotCache, encode
+
+WIDTH, HEIGHT = 782, 600
+
+def columns(display_list, index):
+    return (display_list.kinds, display_list.lefts, display_list.tops, display_list.rights,
+            display_list.bottoms, display_list.font_ids, display_list.payloads,
+            index.short, index.tall, index.tops, index.max_height, index.bottom)
+
+def miss(body, cache, key):
+    # what a load does without a snapshot: parse, lay out, paint, index, save
+    start = time.perf_counter()
+    document = DocumentLayout(HTMLParser(body).parse(), 0, 0, WIDTH, HEIGHT)
+    document.layout()
+    display_list = DisplayList(FONT_TABLE)
+    paint_tree(document, display_list)
+    index = DisplayIndex(display_list)
+    elapsed = time.perf_counter() - start
+    cache.put(key, display_list, index)
+    return display_list, index, elapsed, time.perf_counter() - start - elapsed
+
+def lazy_miss(body, cache, key):
+    # the same with lazy layout, as the browser does by default: a first
+    # screenful, then the rest as scrolling reaches it, and the snapshot
+    # saved once the page is complete
+    start = time.perf_counter()
+    document = DocumentLayout(HTMLParser(body).parse(), 0, 0, WIDTH, HEIGHT)
+    document.layout(2 * HEIGHT)
+    display_list = DisplayList(FONT_TABLE)
+    paint_tree(document, display_list)
+    index = DisplayIndex(display_list)
+    first_frame = time.perf_counter() - start
+    scroll = 0
+    while not document.complete:
+        scroll += HEIGHT
+        blocks, shift = document.extend(scroll + 2 * HEIGHT, scroll)
+        scroll += shift
+        for block in blocks:
+            paint_tree(block, display_list)
+        index.add()
+    cache.put(key, display_list, index)
+    return display_list, index, first_frame
+
+def hit(cache, key):
+    start = time.perf_counter()
+    snapshot = cache.get(key)
+    return snapshot, time.perf_counter() - start
+
+if __name__ == "__main__":
+    pages = [("small", page("small")), ("wiki", page("wiki")),
+             ("large", document(SIZES["large"]))]
+    with tempfile.TemporaryDirectory() as path:
+        for name, body in pages:
+            key = "{}-{}-headless".format(name, WIDTH)
+            display_list, index, miss_time, save_time = miss(body, SnapshotCache(disk_path = path), key)
+            expected = columns(display_list, index)
+            size = len(encode(display_list, index))
+
+            memory = SnapshotCache(disk_path = None)
+            memory.put(key, display_list, index)
+            hit(memory, key)
+            (memory_list, memory_index), memory_time = hit(memory, key)
+            # a fresh cache on the same directory, as after a restart
+            (disk_list, disk_index), disk_time = hit(SnapshotCache(disk_path = path), key)
+            same = columns(memory_list, memory_index) == expected and \
+                columns(disk_list, disk_index) == expected
+
+            print("{:>6}: {:7d} rows, snapshot {:6.2f} MB  miss {:7.3f}s (+{:.3f}s save)"
+                  "  memory hit {:7.4f}s ({:5.0f}x)  disk hit {:7.4f}s ({:5.0f}x){}".format(
+                      name, len(display_list), size / 1e6, miss_time, save_time,
+                      memory_time, miss_time / memory_time, disk_time, miss_time / disk_time,
+                      "" if same else "  SNAPSHOT DIFFERS"))
+
+            # a lazily laid out page is saved once scrolled to the end
+            lazy_key = key + "-lazy"
+            lazy = SnapshotCache(disk_path = None)
+            display_list, index, first_frame = lazy_miss(body, lazy, lazy_key)
+            (lazy_list, lazy_index), lazy_time = hit(lazy, lazy_key)
+            same = columns(lazy_list, lazy_index) == columns(display_list, index)
+            print("{:>6}  lazy: first frame {:7.3f}s, saved after scrolling to the end;"
+                  "  memory hit {:7.4f}s{}".format(
+                      "", first_frame, lazy_time, "" if same else "  SNAPSHOT DIFFERS"))
@@ -0,0 +1,158 @@
+import os
+import random
+import sys
+
+# make the browser modules importable when running scripts from this directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+WORDS = [
+    "browser", "engineering", "layout", "paint", "parse", "token", "the",
+    "of", "and", "a", "to", "in", "is", "that", "for", "it", "with", "as",
+    "was", "on", "be", "at", "by", "this", "had", "not", "are", "but",
+    "from", "or", "have", "an", "they", "which", "one", "you", "were",
+    "her", "all", "she", "there", "would", "their", "we", "him", "been",
+]
+
+ENTITIES = ["&lt;", "&gt;", "&amp;", "&quot;", "&copy;", "&ndash;", "&shy;"]
+
+# every kind of character reference, plus things that only look like one
+ENTITY_SOUP = [
+    "&lt;", "&amp;", "&nbsp;", "&eacute;", "&hellip;", "&CounterClockwiseContourIntegral;",
+    "&#169;", "&#x2014;", "&#X1F600;", "&#128;", "&#0;", "&copy", "&notin;", "&notit;",
+    "&", "& ", "&;", "&#;", "&#x;", "&bogus;", "AT&T", "a&&b", "&amp",
+]
+
+INLINE_TAGS = ["b", "i", "small", "big", "a", "span", "code"]
+
+def sentence(rng, entity_rate = 0.02):
+    words = []
+    for _ in range(rng.randint(4, 18)):
+        if rng.random() < entity_rate:
+            words.append(rng.choice(ENTITIES))
+        else:
+            words.append(rng.choice(WORDS))
+    return " ".join(words).capitalize() + "."
+
+def paragraph(rng, entity_rate = 0.02):
+    out = []
+    for _ in range(rng.randint(2, 6)):
+        s = sentence(rng, entity_rate)
+        if rng.random() < 0.3:
+            tag = rng.choice(INLINE_TAGS)
+            attrs = ' href="/wiki/{}"'.format(rng.choice(WORDS)) if tag == "a" else ""
+            s = "<{}{}>{}</{}>".format(tag, attrs, s, tag)
+        out.append(s)
+    return " ".join(out)
+
+def section(rng, entity_rate = 0.02):
+    out = ["<h2 id=s{}>{}</h2>".format(rng.randint(0, 10**6), sentence(rng))]
+    for _ in range(rng.randint(2, 5)):
+        kind = rng.random()
+        if kind < 0.6:
+            out.append("<p class=body>{}</p>".format(paragraph(rng, entity_rate)))
+        elif kind < 0.75:
+            items = "".join("<li>{}</li>".format(sentence(rng, entity_rate))
+                            for _ in range(rng.randint(2, 6)))
+            out.append("<ul>{}</ul>".format(items))
+        elif kind < 0.85:
+            out.append("<pre>{}</pre>".format(sentence(rng, entity_rate)))
+        elif kind < 0.95:
+            out.append("<!-- {} -->".format(sentence(rng)))
+        else:
+            out.append("<div>{}<br>{}</div>".format(sentence(rng), sentence(rng)))
+    return "\n".join(out)
+
+def document(size, seed = 0, entity_rate = 0.02):
+    # generate a deterministic html page of roughly `size` characters
+    rng = random.Random(seed)
+    out = [
+        "<!doctype html>",
+        "<html><head><title>{}</title>".format(sentence(rng)),
+        '<meta charset="utf-8"><link rel=stylesheet href="/style.css"></head>',
+        "<body>",
+        '<nav class="links"><a href="/">Home</a> <a href="/about">About</a></nav>',
+    ]
+    length = sum(len(s) for s in out)
+    while length < size:
+        s = section(rng, entity_rate)
+        out.append(s)
+        length += len(s) + 1
+    out.append("</body></html>")
+    return "\n".join(out)
+
+def pathological(size, seed = 0, depth = 200):
+    # a page built to stress the parser and layout: deeply nested unclosed
+    # inline tags, stray ampersands, entity soup, huge unbreakable words,
+    # attribute-heavy tags and comments
+    rng = random.Random(seed)
+    out = ["<html><body>"]
+    length = 0
+    while length < size:
+        kind = rng.randrange(6)
+        if kind == 0:
+            s = "".join(rng.choice(["<b>", "<i>", "<span class=x>", "<small>"])
+                        for _ in range(depth)) + sentence(rng)
+            s += "</small></span></i></b>" * (depth // 4)
+        elif kind == 1:
+            s = " ".join(rng.choice(ENTITIES) for _ in range(200))
+        elif kind == 2:
+            s = "<p>" + "x" * rng.randint(1000, 5000) + "</p>"
+        elif kind == 3:
+            attrs = " ".join('data-{}="{} {}"'.format(i, rng.choice(WORDS), rng.choice(WORDS))
+                             for i in range(30))
+            s = "<div {}>{}</div>".format(attrs, paragraph(rng))
+        elif kind == 4:
+            s = "<!--" + "- -> <p> " * 100 + "-->" + sentence(rng)
+        else:
+            s = "<p>AT&T & friends &notanentity " + paragraph(rng, 0.3)
+        out.append(s)
+        length += len(s)
+    out.append("</body></html>")
+    return "\n".join(out)
+
+def nested(depth, tag = "div"):
+    # `depth` elements each inside the last, with a word of text at every level
+    return "<html><body>{}{}</body></html>".format(
+        "<{}>level".format(tag) * depth, "</{}>".format(tag) * depth)
+
+def entity_dense(size, seed = 0):
+    # paragraphs where about half the words are character references
+    rng = random.Random(seed)
+    out = ["<html><body>"]
+    length = 0
+    while length < size:
+        words = [rng.choice(ENTITY_SOUP) if rng.random() < 0.5 else rng.choice(WORDS)
+                 for _ in range(rng.randint(20, 80))]
+        s = "<p>" + " ".join(words) + "</p>"
+        out.append(s)
+        length += len(s)
+    out.append("</body></html>")
+    return "\n".join(out)
+
+def prose(size, seed = 0):
+    # text-heavy page: long paragraphs with a little inline markup, the case
+    # where line breaking dominates layout
+    rng = random.Random(seed)
+    out = ["<html><body>"]
+    length = 0
+    while length < size:
+        s = "<p>" + " ".join(paragraph(rng) for _ in range(rng.randint(5, 30))) + "</p>"
+        out.append(s)
+        length += len(s)
+    out.append("</body></html>")
+    return "\n".join(out)
+
+# pages checked in next to this file, so results don't move when the generator does
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+
+def page(name):
+    with open(os.path.join(PAGES_DIR, name + ".html"), encoding = "utf-8") as f:
+        return f.read()
+
+SIZES = {
+    "small": 4 * 1024,
+    "wiki": 200 * 1024,
+    "large": 2 * 1024 * 1024,
+}
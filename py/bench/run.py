@@ -0,0 +1,170 @@
+# Benchmarks for each phase of loading a page, on the pages in corpus.py:
+#
+#   python run.py --out baseline.json        # save a run
+#   python run.py --compare baseline.json    # compare p50s, exit 1 on regressions
+#   python run.py parse layout/wiki          # only benchmarks with these prefixes
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+# benchmarks must not touch the user's on-disk cache or need a display
+os.environ.setdefault("BROWSER_CACHE_PATH", "")
+os.environ.setdefault("BROWSER_FONT_BACKEND", "headless")
+
+import corpus
+import server
+from html import HTMLParser
+from layout import DocumentLayout, paint_tree, FONT_TABLE
+from draw import DisplayList
+from url import URL, response_cache, connection_pool, REQUEST_HEADERS
+from cache import CachePolicy
+
+WIDTH = 782
+
+def pages():
+    # name -> html for every page in the corpus
+    return {
+        "small": corpus.page("small"),
+        "wiki": corpus.page("wiki"),
+        "large": corpus.document(corpus.SIZES["large"]),
+        "pathological": corpus.pathological(10 * 1024 * 1024),
+        "entities": corpus.entity_dense(1024 * 1024),
+    }
+
+def sample(run, repeat, max_time):
+    # call run() until we have `repeat` timings or have spent max_time seconds;
+    # a quick first run is thrown away to warm the font and word caches
+    deadline = time.perf_counter() + max_time
+    first = run()
+    times = [] if first < max_time / 10 else [first]
+    while len(times) < repeat and (not times or time.perf_counter() < deadline):
+        times.append(run())
+    return times
+
+def percentile(sorted_times, p):
+    i = min(len(sorted_times) - 1, round(p / 100 * (len(sorted_times) - 1)))
+    return sorted_times[i]
+
+def summarize(times, size):
+    times = sorted(times)
+    result = {
+        "samples": len(times),
+        "min": times[0],
+        "mean": sum(times) / len(times),
+        "p50": percentile(times, 50),
+        "p90": percentile(times, 90),
+        "p99": percentile(times, 99),
+        "bytes": size,
+    }
+    result["mb_per_s"] = size / result["p50"] / 1e6 if result["p50"] else None
+    return result
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def bench_parse(body):
+    return lambda: timed(lambda: HTMLParser(body).parse())
+
+def bench_layout(body):
+    nodes = HTMLParser(body).parse()
+    def run():
+        document = DocumentLayout(nodes, 0, 0, WIDTH, 600)
+        return timed(document.layout)
+    return run
+
+def bench_paint(body):
+    document = DocumentLayout(HTMLParser(body).parse(), 0, 0, WIDTH, 600)
+    document.layout()
+    return lambda: timed(lambda: paint_tree(document, DisplayList(FONT_TABLE)))
+
+def bench_cache(body):
+    # a fresh response_cache hit: lookup, decompress and hand back the body
+    url = "http://cache.invalid/{}".format(len(body))
+    policy = CachePolicy({"cache-control": "max-age=3600"})
+    response_cache.put(url, 200, "text/html", policy, REQUEST_HEADERS, body, time.time())
+    return lambda: timed(lambda: URL(url).request())
+
+def bench_fetch(base, size, encoding, chunked):
+    url = "{}/page?size={}&encoding={}&chunked={}".format(base, size, encoding, int(chunked))
+    server.body(size, encoding)
+    return lambda: timed(lambda: URL(url).request(lambda text: None))
+
+def run_all(selected, repeat, max_time):
+    results = {}
+
+    def record(name, run, size):
+        if selected and not any(name.startswith(s) for s in selected):
+            return
+        times = sample(run, repeat, max_time)
+        results[name] = summarize(times, size)
+        print("{:>28}: p50 {:9.4f}s  p90 {:9.4f}s  ({} samples)".format(
+            name, results[name]["p50"], results[name]["p90"], len(times)), file = sys.stderr)
+
+    for name, body in pages().items():
+        size = len(body.encode("utf-8"))
+        record("parse/" + name, bench_parse(body), size)
+        record("layout/" + name, bench_layout(body), size)
+        record("paint/" + name, bench_paint(body), size)
+        record("cache/" + name, bench_cache(body), size)
+
+    base = server.start()
+    size = 1024 * 1024
+    for encoding in ("identity", "gzip"):
+        for chunked in (False, True):
+            name = "fetch/{}-{}".format(encoding, "chunked" if chunked else "length")
+            record(name, bench_fetch(base, size, encoding, chunked), size)
+    connection_pool.close_all()
+    return results
+
+def compare(baseline, results, threshold):
+    # print p50 ratios against a saved run; returns the names that regressed
+    regressed = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["p50"] / baseline[name]["p50"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print("{:>28}: {:9.4f}s -> {:9.4f}s  {:6.2f}x{}".format(
+            name, baseline[name]["p50"], result["p50"], ratio, flag))
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "fetch/parse/layout/paint benchmarks")
+    parser.add_argument("only", nargs = "*", help = "run only benchmarks starting with these names")
+    parser.add_argument("--repeat", type = int, default = 7)
+    parser.add_argument("--max-time", type = float, default = 10.0,
+                        help = "stop sampling a benchmark after this many seconds")
+    parser.add_argument("--out", help = "write results to this json file")
+    parser.add_argument("--compare", help = "compare against a saved results file")
+    parser.add_argument("--threshold", type = float, default = 0.1,
+                        help = "relative p50 slowdown counted as a regression")
+    args = parser.parse_args()
+
+    results = run_all(args.only, args.repeat, args.max_time)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,72 @@
+import gzip
+import http.server
+import threading
+import time
+import zlib
+from urllib.parse import urlparse, parse_qs
+
+from corpus import document
+
+# bodies are expensive to generate, so keep them around between requests
+BODIES = {}
+
+def body(size, encoding):
+    key = (size, encoding)
+    if key not in BODIES:
+        raw = document(size).encode("utf-8")
+        if encoding == "gzip":
+            raw = gzip.compress(raw)
+        elif encoding == "deflate":
+            raw = zlib.compress(raw)
+        BODIES[key] = raw
+    return BODIES[key]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # GET /page?size=N&encoding=gzip|deflate|identity&chunked=0|1&chunk=N&delay=S
+    # serves a generated page; keep-alive is on so connection reuse can be measured
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        Handler.connections += 1
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        size = int(query.get("size", ["65536"])[0])
+        encoding = query.get("encoding", ["identity"])[0]
+        chunked = query.get("chunked", ["0"])[0] == "1"
+        chunk_size = int(query.get("chunk", ["16384"])[0])
+        delay = float(query.get("delay", ["0"])[0])
+        cache = query.get("cache", [None])[0]
+        if delay:
+            time.sleep(delay)
+
+        data = body(size, encoding)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+        if cache:
+            self.send_header("Cache-Control", cache)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(data), chunk_size):
+                piece = data[i:i + chunk_size]
+                self.wfile.write(b"%x\r\n" % len(piece) + piece + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+def start(port = 0):
+    # serve on a background thread; returns the base url
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return "http://127.0.0.1:{}".format(server.server_address[1])
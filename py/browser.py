@@ -2,10 +2,20 @@ import tkinter
 import tkinter.font
 import platform
 import os
+import asyncio
+import threading
+import queue
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from constants import *
-from url import URL
-from html import HTMLParser, print_tree
-from layout import paint_tree, DocumentLayout 
+from url import URL, fetch_many
+from html import HTMLParser, Text, print_tree
+import layout
+from layout import paint_tree, DocumentLayout, FONT_TABLE
+from draw import DisplayList, DisplayIndex, RECT
+from snapshot import layout_snapshots, snapshot_key, body_hash
+from tracing import tracer
 
 class Browser:
     def __init__(self):
@@ -26,6 +36,28 @@ class Browser:
         self.window.bind("<Configure>", self.resize)
         self.detect_platform()
         self.current_url = "about:blank"
+        self.nodes = None
+        self.document = None
+        # the page on screen came from a layout snapshot, so there is no
+        # document to reflow and a width change needs a fresh layout
+        self.from_snapshot = False
+        self.display_list = DisplayList(FONT_TABLE)
+        self.index = DisplayIndex(self.display_list)
+        # canvas items currently showing, keyed by display list row,
+        # and the scroll offset they were drawn at
+        self.canvas_items = {}
+        self.drawn_scroll = 0
+        self.resize_scheduled = False
+
+        # network and parsing run on a background asyncio loop and layout on
+        # its own thread; results come back to the Tk thread through a queue
+        # that we poll
+        self.messages = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target = self.loop.run_forever, daemon = True).start()
+        self.layout_executor = ThreadPoolExecutor(1, thread_name_prefix = "layout")
+        self.current_load = None
+        self.window.after(POLL_INTERVAL, self.poll)
 
     def display_rect(self):
         screen_width = self.canvas.width - SCROLLBAR_WIDTH - SCROLLBAR_OFFSET
@@ -35,18 +67,76 @@ class Browser:
         y2 = HEIGHT 
         return x1, y1, x2, y2
 
-    def update_layout(self):
-        self.document = DocumentLayout(self.nodes, *(self.display_rect()))
-        self.document.layout()
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+    def relayout(self):
+        # lay out the current tree again; measured words and the block
+        # tree are kept, so this only redoes line breaking
+        self.document.x1, self.document.y1, self.document.x2, self.document.y2 = \
+            self.display_rect()
+        self.document.layout(self.layout_bottom())
+        display_list = DisplayList(FONT_TABLE)
+        with tracer.span("paint"):
+            paint_tree(self.document, display_list)
+            index = DisplayIndex(display_list)
+        self.set_display_list(display_list, index, True)
+
+    def layout_bottom(self):
+        # how far down the page layout has to go for what's on screen, or
+        # None to lay out the whole page
+        if not LAZY_LAYOUT: return None
+        return self.scroll + self.canvas.height + LAZY_OVERSCAN
+
+    def extend_layout(self):
+        # lay out blocks that scrolling has brought near the viewport, paint
+        # them after what's already painted, and keep the content on screen
+        # where it was as their real heights replace the estimates
+        if self.document is None: return
+        while True:
+            blocks, shift = self.document.extend(self.layout_bottom(), self.scroll)
+            if not blocks: return
+            self.scroll += shift
+            with tracer.span("paint"):
+                for block in blocks:
+                    paint_tree(block, self.display_list)
+                self.index.add()
+            if self.document.complete:
+                # the page is all there now; nothing appends to this list
+                # again, so the layout thread can save it
+                self.watch(self.layout_executor.submit(
+                    self.save_snapshot, self.current_load, self.document.x2,
+                    self.display_list, self.index))
+
+    def set_display_list(self, display_list, index, replace):
+        # replace is False when display_list only has rows added since the
+        # last call, so the canvas items already drawn are still good
+        self.display_list = display_list
+        self.index = index
+        if replace:
+            self.canvas.delete("content")
+            self.canvas_items = {}
         self.draw()
 
     def resize(self, e):
-        self.canvas.width = e.width
-        self.canvas.height = e.height
-        self.update_layout()
-        self.draw()
+        # a drag produces a burst of <Configure> events; only act on the
+        # last one, once Tk has gone idle
+        self.pending_size = (e.width, e.height)
+        if not self.resize_scheduled:
+            self.resize_scheduled = True
+            self.window.after_idle(self.apply_resize)
+
+    def apply_resize(self):
+        self.resize_scheduled = False
+        width, height = self.pending_size
+        if (width, height) == (self.canvas.width, self.canvas.height): return
+        width_changed = width != self.canvas.width
+        self.canvas.width = width
+        self.canvas.height = height
+        if width_changed and self.document:
+            self.relayout()
+        elif width_changed and self.from_snapshot:
+            self.reflow()
+        else:
+            # nothing moves horizontally, so the layout is still good
+            self.draw()
 
     def detect_platform(self):
         os = platform.system()
@@ -79,9 +169,11 @@ class Browser:
 
     def draw_addressbar(self):
         self.canvas.create_rectangle(
-            0, 0, self.canvas.width, ADDRESSBAR_HEIGHT, fill = "white"
+            0, 0, self.canvas.width, ADDRESSBAR_HEIGHT, fill = "white",
+            tags = "chrome"
         )
-        self.canvas.create_text(HSTEP, VSTEP/4, text = self.current_url, anchor = "nw")
+        self.canvas.create_text(HSTEP, VSTEP/4, text = self.current_url, anchor = "nw",
+                                tags = "chrome")
 
     def draw_scrollbar(self):
         halfwidth = 0.5 * SCROLLBAR_WIDTH
@@ -95,56 +187,299 @@ class Browser:
         self.canvas.create_rectangle(
             scrollbar_x - halfwidth, scrollbar_y,
             scrollbar_x + halfwidth, self.canvas.height,
-            fill = "darkgray", outline = "darkgray"
+            fill = "darkgray", outline = "darkgray",
+            tags = "chrome"
         )
 
         self.canvas.create_rectangle(
             scrollbar_x - halfwidth, scroll_pos,
             scrollbar_x + halfwidth, scroll_pos + scroll_height,
-            fill = "lightgray", outline = "lightgray"
+            fill = "lightgray", outline = "lightgray",
+            tags = "chrome"
         )
 
     def draw(self):
+        with tracer.span("draw"):
+            self.extend_layout()
+            self.draw_viewport()
+
+    def draw_viewport(self):
+        bottom = self.index.bottom
+        if self.document is not None:
+            # blocks not laid out yet still count, at their estimated heights
+            bottom = max(bottom, self.document.y + self.document.height)
+        self.max_scroll = max(bottom + self.bottom_margin - self.canvas.height, VSTEP)
         self.scroll = min(max(0, self.scroll), self.max_scroll)
-        self.canvas.delete("all")
 
-        self.max_scroll = VSTEP
+        # shift everything already on the canvas in one call, then only
+        # create and delete the items entering and leaving the viewport
+        if self.scroll != self.drawn_scroll:
+            self.canvas.move("content", 0, self.drawn_scroll - self.scroll)
+            self.drawn_scroll = self.scroll
 
-        for cmd in self.display_list:
-            self.max_scroll = max(
-                cmd.bottom + self.bottom_margin - self.canvas.height,
-                self.max_scroll
-            )
+        visible = self.index.visible(self.scroll, self.scroll + self.canvas.height)
+        showing = set(visible)
+        for i in [i for i in self.canvas_items if i not in showing]:
+            self.canvas.delete(self.canvas_items.pop(i))
 
-        for cmd in self.display_list: 
-            if cmd.top > self.scroll + self.canvas.height: continue
-            if cmd.bottom < self.scroll: continue
-            cmd.execute(self.scroll, self.canvas)
+        for i in visible:
+            if i in self.canvas_items: continue
+            item = self.display_list[i].execute(self.scroll, self.canvas, "content")
+            if self.display_list.kinds[i] == RECT:
+                # backgrounds go underneath any text already drawn
+                self.canvas.tag_lower(item)
+            self.canvas_items[i] = item
+            tracer.count("canvas items created")
 
+        self.canvas.delete("chrome")
         self.draw_scrollbar()
         self.draw_addressbar()
 
+    def post(self, callback, *args):
+        # Tk may only be touched from its own thread, so workers go through here
+        self.messages.put((callback, args))
+
+    def watch(self, future, load = None):
+        # futures from the layout thread and the event loop keep their
+        # exceptions to themselves; print them, and if they were loading the
+        # page on screen, show what went wrong rather than a blank window
+        future.add_done_callback(lambda future: self.check(future, load))
+
+    def check(self, future, load):
+        if future.cancelled(): return
+        error = future.exception()
+        if error is None: return
+        traceback.print_exception(error)
+        if load is not None:
+            self.post(self.show_error, load, error)
+
+    def show_error(self, load, error):
+        if load is not self.current_load: return
+        message = "Error loading {}: {!r}".format(load.url.url, error)
+        self.document = DocumentLayout(Text(message, None), *self.display_rect())
+        self.from_snapshot = False
+        self.relayout()
+
+    def poll(self):
+        while True:
+            try:
+                callback, args = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        self.window.after(POLL_INTERVAL, self.poll)
 
     def load(self, path):
         url = URL(path)
         self.current_url = url.url
-        body, _, _ = url.request()
+        load = PageLoad(url)
+        self.current_load = load
+        # the layout thread owns layout until this load is shown, so resizes
+        # in the meantime just redraw
+        self.document = None
+        self.from_snapshot = False
+        self.watch(asyncio.run_coroutine_threadsafe(self.fetch(load), self.loop), load)
 
-        if url.content_type.startswith("text/html"):
-            self.nodes = HTMLParser(body).parse()
+    def reflow(self):
+        # the page was shown from a snapshot at another width: lay out the
+        # tree if we parsed one, otherwise load the page again, which will
+        # come from the response cache
+        load = self.current_load
+        self.from_snapshot = False
+        if load and load.nodes is not None:
+            self.watch(self.layout_executor.submit(self.lay_out, load, load.nodes, False), load)
         else:
-            self.nodes = Text(body)
+            self.load(self.current_url)
 
-        self.update_layout()
-        self.draw()
+    async def fetch(self, load):
+        try:
+            await load.url.request_async(lambda chunk: self.receive(load, chunk))
+        except Exception as e:
+            load.plain_text = ["Error loading {}: {!r}".format(load.url.url, e)]
+            load.url.content_type = "text/plain"
+            load.failed = True
+
+        if load.snapshot:
+            self.post(self.show_snapshot, load, load.snapshot)
+            return
+
+        with load.lock:
+            if load.url.content_type.startswith("text/html"):
+                nodes = load.parser.close()
+            else:
+                nodes = Text("".join(load.plain_text), None)
+        self.watch(self.layout_executor.submit(self.lay_out, load, nodes, False), load)
+
+    def receive(self, load, chunk):
+        # called on a worker thread by URL.request as the body arrives,
+        # so parsing overlaps with I/O and stays off the Tk thread
+        if load.hash is None:
+            load.hash = body_hash(load.url.content_type)
+        load.hash.update(chunk.encode("utf-8"))
+        if load.url.whole_body:
+            # the complete body in one go, typically from the response cache:
+            # if we've laid it out at this width before, skip parsing it
+            load.snapshot = self.lookup_snapshot(load)
+            if load.snapshot: return
+
+        if not load.url.content_type.startswith("text/html"):
+            load.plain_text.append(chunk)
+            return
+
+        with load.lock:
+            load.parser.feed(chunk)
+        load.received += len(chunk)
+
+        if len(load.parser.links) > load.prefetched:
+            # warm the cache with stylesheets etc. the page will want later
+            links = [load.url.resolve(href) for href in load.parser.links[load.prefetched:]]
+            load.prefetched = len(load.parser.links)
+            self.watch(asyncio.run_coroutine_threadsafe(fetch_many(links), self.loop))
+
+        if not load.painted and load.received >= FIRST_PAINT_SIZE:
+            # show whatever has been parsed so far while the rest downloads
+            load.painted = True
+            self.watch(self.layout_executor.submit(self.lay_out, load, None, True), load)
+
+    def lay_out(self, load, nodes, preview):
+        # runs on the layout thread. Paints each block as it is finished and
+        # hands the display list to the Tk thread once the first screenful is
+        # covered, then every PROGRESS_INTERVAL. A preview lays out the
+        # partial tree under the parser's lock and stops at the first screenful.
+        if load is not self.current_load: return
+        if preview:
+            with load.lock:
+                self.lay_out_tree(load, load.parser.tree(), preview)
+        else:
+            self.lay_out_tree(load, nodes, preview)
+
+    def lay_out_tree(self, load, nodes, preview):
+        if nodes is None: return
+        if not preview:
+            load.nodes = nodes
+            snapshot = self.lookup_snapshot(load)
+            if snapshot:
+                self.post(self.show_snapshot, load, snapshot)
+                return
+        document = DocumentLayout(nodes, *self.display_rect())
+        screen_bottom = self.canvas.height
+        display_list = DisplayList(FONT_TABLE)
+        replace = True
+        posted = None
+        with tracer.span("layout", preview = preview):
+            for block in document.layout_steps(None if preview else self.layout_bottom()):
+                if load is not self.current_load: return
+                block.paint(display_list)
+                if block.y + block.height < screen_bottom:
+                    continue
+                now = time.perf_counter()
+                if posted is None or now - posted > PROGRESS_INTERVAL:
+                    if preview: break
+                    self.post(self.show_progress, load, display_list, len(display_list), replace)
+                    replace = False
+                    posted = now
+
+        if preview:
+            self.post(self.show_progress, load, display_list, len(display_list), True)
+            return
+
+        # the progressive list has parents after their children; paint the
+        # finished tree in the usual order for the final result
+        display_list = DisplayList(FONT_TABLE)
+        with tracer.span("paint"):
+            paint_tree(document, display_list)
+            index = DisplayIndex(display_list)
+        self.post(self.show, load, document, display_list, index)
+        # a snapshot has to cover the whole page, so a lazy layout is saved
+        # by extend_layout once scrolling has finished it
+        if document.complete:
+            self.save_snapshot(load, document.x2, display_list, index)
+
+    def save_snapshot(self, load, width, display_list, index):
+        key = self.snapshot_key(load, width)
+        if not key: return
+        with tracer.span("save snapshot"):
+            layout_snapshots.put(key, display_list, index)
+
+    def snapshot_key(self, load, width):
+        if load.hash is None or load.failed: return None
+        return snapshot_key(load.hash.hexdigest(), width, layout.font_backend.name)
+
+    def lookup_snapshot(self, load):
+        # (display_list, index) laid out earlier for this body at the current
+        # width, or None
+        load.width = self.display_rect()[2]
+        key = self.snapshot_key(load, load.width)
+        if not key: return None
+        with tracer.span("load snapshot"):
+            return layout_snapshots.get(key)
+
+    def show_progress(self, load, display_list, rows, replace):
+        # the layout thread is still appending to display_list, so only the
+        # first `rows` rows are safe to read; the index is extended to cover
+        # them, and items already on the canvas stay unless this is a new list
+        if load is not self.current_load or self.document is not None: return
+        if replace:
+            index = DisplayIndex(display_list, rows)
+        else:
+            index = self.index
+            index.add(rows)
+        self.set_display_list(display_list, index, replace)
+
+    def show(self, load, document, display_list, index):
+        if load is not self.current_load: return
+        self.nodes = document.node
+        self.document = document
+        self.from_snapshot = False
+        if document.x2 != self.display_rect()[2]:
+            # the window was resized while the page was being laid out
+            self.relayout()
+        else:
+            self.set_display_list(display_list, index, True)
+        tracer.snapshot()
 
         #print_tree(self.nodes)
        # print_tree(self.document)
 
+    def show_snapshot(self, load, snapshot):
+        if load is not self.current_load: return
+        self.nodes = load.nodes
+        self.from_snapshot = True
+        display_list, index = snapshot
+        self.set_display_list(display_list, index, True)
+        if load.width != self.display_rect()[2]:
+            # the window was resized while the snapshot was being read
+            self.reflow()
+        tracer.snapshot()
+
+class PageLoad:
+    # state of one in-flight page load
+    def __init__(self, url):
+        self.url = url
+        self.parser = HTMLParser()
+        self.plain_text = []
+        self.received = 0
+        self.painted = False
+        self.prefetched = 0
+        self.lock = threading.Lock()
+        # content hash of the body, for finding a layout snapshot of it
+        self.hash = None
+        self.failed = False
+        self.width = None
+        self.snapshot = None
+        self.nodes = None
+
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) > 1:
-        url = sys.argv[1]
+    args = sys.argv[1:]
+    if "--trace" in args:
+        # --trace out.json writes a Chrome trace of the session on exit
+        i = args.index("--trace")
+        tracer.enable(args[i + 1])
+        del args[i:i + 2]
+
+    if args:
+        url = args[0]
     else: 
         url = "http://example.org"
 
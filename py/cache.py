@@ -0,0 +1,213 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from lru import LRU
+
+# in-memory layer holds this many bytes of compressed bodies
+MEMORY_CACHE_SIZE = 32 * 1024 * 1024
+# the on-disk store is trimmed back to this many bytes of compressed bodies
+DISK_CACHE_SIZE = 256 * 1024 * 1024
+# set BROWSER_CACHE_PATH to an empty string to keep the cache in memory only
+DISK_CACHE_PATH = os.environ.get("BROWSER_CACHE_PATH", os.path.join(
+    os.path.expanduser("~"), ".cache", "archermarx-browser", "http-cache.sqlite"))
+
+class CacheEntry:
+    def __init__(self, url, status, content_type, stored_at, max_age, etag, last_modified, vary, body):
+        self.url = url
+        self.status = status
+        self.content_type = content_type
+        self.stored_at = stored_at
+        self.max_age = max_age
+        self.etag = etag
+        self.last_modified = last_modified
+        # ((header, value), ...) of the request headers named in Vary
+        self.vary = vary
+        # zlib-compressed utf-8 body
+        self.body = body
+
+    def fresh(self, now):
+        return now - self.stored_at < self.max_age
+
+    def content(self):
+        return zlib.decompress(self.body).decode("utf-8")
+
+    def validators(self):
+        # headers that turn a refetch into a conditional request
+        headers = {}
+        if self.etag:
+            headers["if-none-match"] = self.etag
+        if self.last_modified:
+            headers["if-modified-since"] = self.last_modified
+        return headers
+
+    def matches(self, request_headers):
+        return all(request_headers.get(name, "") == value for name, value in self.vary)
+
+    def size(self):
+        return len(self.body) + len(self.url)
+
+class CachePolicy:
+    # what a response's headers allow us to do with it
+    def __init__(self, response_headers):
+        self.store = True
+        self.max_age = 0.0
+        self.etag = response_headers.get("etag")
+        self.last_modified = response_headers.get("last-modified")
+
+        no_cache = False
+        max_age = None
+        if "cache-control" in response_headers:
+            for opt in response_headers["cache-control"].split(","):
+                opt = opt.strip().casefold()
+                if opt == "no-store":
+                    self.store = False
+                elif opt == "no-cache":
+                    no_cache = True
+                elif opt.startswith("max-age") and "=" in opt:
+                    _, val = opt.split("=", 1)
+                    try:
+                        max_age = float(val.strip('"'))
+                    except ValueError:
+                        no_cache = True
+                # public, private, must-revalidate etc. need no special handling
+                # in a single-user cache that always revalidates stale entries
+
+        if max_age is not None and not no_cache:
+            self.max_age = max_age
+
+        self.vary = []
+        if "vary" in response_headers:
+            self.vary = [name.strip().casefold()
+                         for name in response_headers["vary"].split(",") if name.strip()]
+            if "*" in self.vary:
+                self.store = False
+
+        # without a lifetime there is no point keeping the body unless it can be revalidated
+        if self.max_age < 1.0 and not (self.etag or self.last_modified):
+            self.store = False
+
+class DiskStore:
+    def __init__(self, path, capacity = DISK_CACHE_SIZE):
+        self.capacity = capacity
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY, status INTEGER, content_type TEXT,
+                stored_at REAL, max_age REAL,
+                etag TEXT, last_modified TEXT, vary TEXT, body BLOB, last_used REAL)
+        """)
+        self.db.commit()
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(body) + LENGTH(url)), 0) FROM entries").fetchone()[0]
+
+    def get(self, url):
+        row = self.db.execute(
+            "SELECT status, content_type, stored_at, max_age, etag, last_modified, vary, body "
+            "FROM entries WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        status, content_type, stored_at, max_age, etag, last_modified, vary, body = row
+        self.db.execute("UPDATE entries SET last_used = ? WHERE url = ?", (time.time(), url))
+        self.db.commit()
+        return CacheEntry(url, status, content_type, stored_at, max_age, etag, last_modified,
+                          decode_vary(vary), body)
+
+    def put(self, entry):
+        old = self.db.execute(
+            "SELECT LENGTH(body) + LENGTH(url) FROM entries WHERE url = ?", (entry.url,)).fetchone()
+        if old:
+            self.size -= old[0]
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry.url, entry.status, entry.content_type, entry.stored_at, entry.max_age, entry.etag,
+             entry.last_modified, encode_vary(entry.vary), entry.body, time.time()))
+        self.size += entry.size()
+        self.trim()
+        self.db.commit()
+
+    def trim(self):
+        # drop the least recently used entries until we're back under capacity
+        while self.size > self.capacity:
+            row = self.db.execute(
+                "SELECT url, LENGTH(body) + LENGTH(url) FROM entries "
+                "ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                self.size = 0
+                break
+            self.db.execute("DELETE FROM entries WHERE url = ?", (row[0],))
+            self.size -= row[1]
+
+    def close(self):
+        self.db.close()
+
+def encode_vary(vary):
+    return "\n".join(name + ":" + value for name, value in vary)
+
+def decode_vary(text):
+    if not text:
+        return ()
+    return tuple(tuple(line.split(":", 1)) for line in text.split("\n"))
+
+class ResponseCache(LRU):
+    # compressed responses keyed by URL, in memory and, optionally, in a
+    # sqlite database that survives restarts
+    def __init__(self, capacity = MEMORY_CACHE_SIZE, disk_path = DISK_CACHE_PATH):
+        super().__init__(capacity)
+        self.disk_path = disk_path
+        self.disk = None
+        self.lock = threading.Lock()
+
+    def sizeof(self, entry):
+        return entry.size()
+
+    def store(self):
+        # open the disk store on first use; fall back to memory only if we can't
+        if self.disk is None and self.disk_path:
+            try:
+                self.disk = DiskStore(self.disk_path)
+            except (OSError, sqlite3.Error):
+                self.disk_path = None
+        return self.disk
+
+    def lookup(self, url, request_headers):
+        with self.lock:
+            entry = self.recall(url)
+            if entry is None and self.store():
+                entry = self.disk.get(url)
+                if entry is not None:
+                    self.remember(url, entry)
+            if entry is None or not entry.matches(request_headers):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def put(self, url, status, content_type, policy, request_headers, content, now):
+        vary = tuple((name, request_headers.get(name, "")) for name in policy.vary)
+        entry = CacheEntry(url, status, content_type, now, policy.max_age, policy.etag,
+                           policy.last_modified, vary, zlib.compress(content.encode("utf-8")))
+        with self.lock:
+            self.remember(url, entry)
+            if self.store():
+                self.disk.put(entry)
+        return entry
+
+    def refresh(self, entry, policy, now):
+        # a 304 confirmed the entry; restart its lifetime with the new headers
+        entry.stored_at = now
+        entry.max_age = policy.max_age
+        entry.etag = policy.etag or entry.etag
+        entry.last_modified = policy.last_modified or entry.last_modified
+        with self.lock:
+            if self.store():
+                self.disk.put(entry)
+
+    def clear(self):
+        with self.lock:
+            super().clear()
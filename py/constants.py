@@ -5,3 +5,11 @@ HSTEP, VSTEP = 13, 18
 ADDRESSBAR_HEIGHT = 1.25 * VSTEP
 SCROLLBAR_WIDTH = HSTEP
 SCROLLBAR_OFFSET = 5
+FIRST_PAINT_SIZE = 32 * 1024
+POLL_INTERVAL = 16
+# seconds of layout between progressive paints while a page loads
+PROGRESS_INTERVAL = 0.1
+# lay out only the blocks near the viewport, estimating the height of the rest
+LAZY_LAYOUT = True
+# how far below the viewport lazy layout reaches
+LAZY_OVERSCAN = HEIGHT
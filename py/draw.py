@@ -1,24 +1,34 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
 class DrawText:
-    def __init__(self, x1, y1, text, font):
+    __slots__ = ("top", "left", "bottom", "text", "font")
+
+    def __init__(self, x1, y1, text, font, linespace = None):
         self.top = y1
         self.left = x1
         self.text = text
         self.font = font
 
-        self.bottom = y1 + font.metrics("linespace")
+        if linespace is None:
+            linespace = font.metrics("linespace")
+        self.bottom = y1 + linespace
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    def execute(self, scroll, canvas, tags = ()):
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
             font=self.font,
-            anchor='nw')
+            anchor='nw',
+            tags=tags)
 
     def __repr__(self):
         return "DrawText(top={} left={} bottom={} text={} font={})".format(
             self.top, self.left, self.bottom, self.text, self.font)
 
 class DrawRect:
+    __slots__ = ("top", "left", "bottom", "right", "color")
+
     def __init__(self, x1, y1, x2, y2, color):
         self.top = y1
         self.left = x1
@@ -26,15 +36,155 @@ class DrawRect:
         self.right = x2
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, tags = ()):
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
-            fill=self.color)
+            fill=self.color,
+            tags=tags)
 
     def __repr__(self):
         return "DrawRect(top={} left={} bottom={} right={} color={})".format(
             self.top, self.left, self.bottom, self.right, self.color)
 
+# row kinds in a DisplayList
+TEXT = 0
+RECT = 1
+
+class DisplayList:
+    # struct-of-arrays display list: one row per command, with coordinates in
+    # parallel float columns, text as (interned) strings and fonts as small
+    # ids into a shared font table. Draw objects are only made on demand.
+    def __init__(self, fonts):
+        self.fonts = fonts
+        self.kinds = array("b")
+        self.lefts = array("d")
+        self.tops = array("d")
+        self.rights = array("d")
+        self.bottoms = array("d")
+        self.font_ids = array("i")
+        # the word for text rows, the fill color for rect rows
+        self.payloads = []
+
+    def text(self, x, y, word, font_id, linespace):
+        self.kinds.append(TEXT)
+        self.lefts.append(x)
+        self.tops.append(y)
+        self.rights.append(x)
+        self.bottoms.append(y + linespace)
+        self.font_ids.append(font_id)
+        self.payloads.append(word)
+
+    def texts(self, xs, ys, words, font_ids, linespaces):
+        # many text rows at once, one sequence per column
+        self.kinds.extend(array("b", [TEXT]) * len(words))
+        self.lefts.extend(xs)
+        self.tops.extend(ys)
+        self.rights.extend(xs)
+        self.bottoms.extend([y + linespace for y, linespace in zip(ys, linespaces)])
+        self.font_ids.extend(font_ids)
+        self.payloads.extend(words)
+
+    def rect(self, x1, y1, x2, y2, color):
+        self.kinds.append(RECT)
+        self.lefts.append(x1)
+        self.tops.append(y1)
+        self.rights.append(x2)
+        self.bottoms.append(y2)
+        self.font_ids.append(-1)
+        self.payloads.append(color)
+
+    def extend(self, other):
+        self.kinds.extend(other.kinds)
+        self.lefts.extend(other.lefts)
+        self.tops.extend(other.tops)
+        self.rights.extend(other.rights)
+        self.bottoms.extend(other.bottoms)
+        self.font_ids.extend(other.font_ids)
+        self.payloads.extend(other.payloads)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        if self.kinds[i] == TEXT:
+            return DrawText(self.lefts[i], self.tops[i], self.payloads[i],
+                            self.fonts[self.font_ids[i]], self.bottoms[i] - self.tops[i])
+        return DrawRect(self.lefts[i], self.tops[i], self.rights[i], self.bottoms[i],
+                        self.payloads[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+# commands taller than this are kept out of the sorted index and checked one by one
+TALL_COMMAND = 100
+
+class DisplayIndex:
+    # rows of a DisplayList sorted by top, so finding the rows that overlap a
+    # range of the page is a binary search plus the rows actually found
+    def __init__(self, display_list, size = None):
+        self.display_list = display_list
+        self.short = array("l")
+        self.tall = array("l")
+        self.tops = array("d")
+        self.max_height = 0
+        self.bottom = 0
+        # rows of the display list indexed so far
+        self.size = 0
+        self.add(size)
+
+    @classmethod
+    def from_arrays(cls, display_list, short, tall, tops, max_height, bottom):
+        # an index built earlier over the same rows, e.g. from a layout snapshot
+        index = cls(display_list, 0)
+        index.short = short
+        index.tall = tall
+        index.tops = tops
+        index.max_height = max_height
+        index.bottom = bottom
+        index.size = len(display_list)
+        return index
+
+    def add(self, size = None):
+        # index rows appended to the display list since the last call, up to
+        # row `size` (by default all of them)
+        if size is None:
+            size = len(self.display_list)
+        tops = self.display_list.tops
+        bottoms = self.display_list.bottoms
+        order = sorted(range(self.size, size), key = tops.__getitem__)
+
+        short = []
+        for i in order:
+            height = bottoms[i] - tops[i]
+            if height > TALL_COMMAND:
+                self.tall.append(i)
+            else:
+                short.append(i)
+                self.max_height = max(self.max_height, height)
+
+        if short and self.tops and tops[short[0]] < self.tops[-1]:
+            # some new rows go above ones already indexed; this is a merge of
+            # two sorted runs, which sorted() does in linear time
+            short = sorted(list(self.short) + short, key = tops.__getitem__)
+            self.short = array("l", short)
+            self.tops = array("d", [tops[i] for i in short])
+        else:
+            self.short.extend(short)
+            self.tops.extend([tops[i] for i in short])
+        self.bottom = max(self.bottom, max(bottoms[self.size:size], default = 0))
+        self.size = size
 
+    def visible(self, top, bottom):
+        # rows of the display list overlapping [top, bottom]
+        tops = self.display_list.tops
+        bottoms = self.display_list.bottoms
+        start = bisect_left(self.tops, top - self.max_height)
+        end = bisect_right(self.tops, bottom)
+        found = [i for i in self.short[start:end] if bottoms[i] >= top]
+        for i in self.tall:
+            if tops[i] <= bottom and bottoms[i] >= top:
+                found.append(i)
+        return found
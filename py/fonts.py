@@ -0,0 +1,101 @@
+import os
+
+# Times-Roman advance widths for printable ASCII, in thousandths of an em
+TIMES_ADVANCES = dict(zip(
+    " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~",
+    [250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+     500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+     921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+     556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+     333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+     500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541]))
+
+MONOSPACE_FAMILIES = ["courier", "courier new", "monospace", "consolas", "menlo"]
+
+class TkFontBackend:
+    # real fonts, measured by Tk; needs a display and a Tk root
+    name = "tk"
+
+    def __init__(self):
+        # labels keep a widget using each font alive, which makes metrics() faster
+        self.labels = []
+
+    def create(self, family, size, weight, style):
+        import tkinter
+        import tkinter.font
+        font = tkinter.font.Font(
+            family = family,
+            size = size, weight = weight, slant = style
+        )
+        self.labels.append(tkinter.Label(font=font))
+        return font
+
+    def measure_many(self, font, words):
+        # one Tcl round trip for the whole batch instead of one per word
+        if not words:
+            return []
+        script = "font measure {{{}}} $w".format(font.name)
+        widths = font.tk.call("lmap", "w", tuple(words), script)
+        return [int(w) for w in font.tk.splitlist(widths)]
+
+class HeadlessFont:
+    # deterministic stand-in for tkinter.font.Font built from an advance table;
+    # answers measure() and metrics() the same way, in whole pixels
+    def __init__(self, family, size, weight, style):
+        self.family = family
+        self.size = size
+        self.weight = weight
+        self.slant = style
+
+        # Tk sizes are in points; assume 96 dpi
+        px = size * 96 / 72
+        if family.casefold() in MONOSPACE_FAMILIES:
+            self.advances = {}
+            self.default_advance = 0.6 * px
+        else:
+            scale = 1.08 if weight == "bold" else 1.0
+            self.advances = {c: a * px * scale / 1000 for c, a in TIMES_ADVANCES.items()}
+            self.default_advance = 0.5 * px * scale
+        self.ascent = round(0.891 * px)
+        self.descent = round(0.216 * px)
+
+    def measure(self, text):
+        advances = self.advances
+        default = self.default_advance
+        return round(sum([advances.get(c, default) for c in text]))
+
+    def metrics(self, *options):
+        metrics = {
+            "ascent": self.ascent,
+            "descent": self.descent,
+            "linespace": self.ascent + self.descent,
+            "fixed": 0 if self.advances else 1,
+        }
+        if options:
+            return metrics[options[0]]
+        return metrics
+
+    def __repr__(self):
+        return "HeadlessFont({}, {}, {}, {})".format(
+            self.family, self.size, self.weight, self.slant)
+
+class HeadlessFontBackend:
+    # no display needed, so layout can run in CI, worker processes and benchmarks
+    name = "headless"
+
+    def create(self, family, size, weight, style):
+        return HeadlessFont(family, size, weight, style)
+
+    def measure_many(self, font, words):
+        return [font.measure(word) for word in words]
+
+FONT_BACKENDS = {
+    "tk": TkFontBackend,
+    "headless": HeadlessFontBackend,
+}
+
+def make_backend(name = None):
+    # pick a backend by name, defaulting to $BROWSER_FONT_BACKEND or Tk
+    if name is None:
+        name = os.environ.get("BROWSER_FONT_BACKEND", "tk")
+    return FONT_BACKENDS[name]()
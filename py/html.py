@@ -1,127 +1,277 @@
+import re
+import sys
 from enum import Enum
+from entities import ENTITIES, LEGACY_ENTITIES, NUMERIC_REPLACEMENTS
+from tracing import tracer
+
+# children of every node that can't have any, shared so that text nodes and
+# empty elements don't each carry an empty list
+NO_CHILDREN = ()
 
 class Text:
+    __slots__ = ("text", "parent")
+    children = NO_CHILDREN
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
         self.parent = parent
 
     def __repr__(self):
         return repr(self.text)
 
 class Element:
-    def __init__(self, tag, attributes, parent):
+    __slots__ = ("tag", "parsed_attributes", "attribute_text", "children", "parent",
+                 "is_block", "has_block_children", "groups")
+
+    def __init__(self, tag, attributes, parent, attribute_text = ""):
         self.tag = tag
-        self.attributes = attributes
+        # attributes is None until someone asks for it, and then it's
+        # parsed from the raw text after the tag name
+        self.parsed_attributes = attributes
+        self.attribute_text = attribute_text
         self.children = []
         self.parent = parent
+        # filled in by layout.classify
+        self.is_block = False
+        self.has_block_children = False
+        self.groups = None
     
+    @property
+    def attributes(self):
+        if self.parsed_attributes is None:
+            self.parsed_attributes = parse_attributes(self.attribute_text)
+            self.attribute_text = ""
+        return self.parsed_attributes
+
     def __repr__(self):
         return "<" + self.tag + ">"
 
-HTMLParseState = Enum('HTMLParseState', [
-    'InText', "InTag", "InEntity", "InComment",
+TEXT_DELIMITERS = re.compile("[<&]")
+
+# what may follow an "&": a hex or decimal number or a name, then maybe a ";".
+# Numbers take every digit, as HTML5 does before clamping, which can't run
+# into markup; the bound on names caps how far a stray "&" makes us look
+# ahead, since the longest named reference is 31 characters
+CHAR_REFERENCE = re.compile("(#[xX][0-9a-fA-F]*|#[0-9]*|[A-Za-z][A-Za-z0-9]{0,31})(;?)")
+# more significant digits than this is past the last code point in any base
+MAX_DIGITS = 8
+LEGACY_LENGTH = max(len(name) for name in LEGACY_ENTITIES)
+
+# the tag name at the start of a tag's text: up to whitespace or a "/" that
+# isn't the leading one of a close tag
+TAG_NAME = re.compile(r"\s*(/?[^\s/]*)")
+# one attribute: a name, then maybe "=" and a double-, single- or unquoted value
+ATTRIBUTE = re.compile(r"""([^\s"'/=][^\s"'/=]*)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|(\S*)))?""")
+
+# raw tag and attribute names mapped to their interned, casefolded form
+NAMES = {}
+MAX_NAMES = 10_000
+
+InsertionMode = Enum('InsertionMode', [
+    'BeforeHtml', "BeforeBody", "InHead", "InBody",
+])
+
+# opening tags that close the ones named by the first set, as long as none
+# of the second set comes first on the way down the stack
+P_SCOPE = frozenset([
+    "html", "table", "td", "th", "caption", "button", "object", "marquee", "applet", "template",
 ])
+LIST_SCOPE = P_SCOPE | {"ol", "ul"}
+TABLE_SCOPE = frozenset(["html", "table", "template"])
+CLOSES_P = (frozenset(["p"]), P_SCOPE)
+AUTO_CLOSE = {tag: CLOSES_P for tag in [
+    "address", "article", "aside", "blockquote", "details", "div", "dl",
+    "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3",
+    "h4", "h5", "h6", "header", "hgroup", "hr", "main", "menu", "nav", "ol",
+    "p", "pre", "section", "summary", "table", "ul",
+]}
+AUTO_CLOSE.update({
+    "li": (frozenset(["li", "p"]), LIST_SCOPE),
+    "dd": (frozenset(["dd", "dt", "p"]), P_SCOPE),
+    "dt": (frozenset(["dd", "dt", "p"]), P_SCOPE),
+    "tr": (frozenset(["tr", "td", "th"]), TABLE_SCOPE),
+    "td": (frozenset(["td", "th"]), TABLE_SCOPE | {"tr"}),
+    "th": (frozenset(["td", "th"]), TABLE_SCOPE | {"tr"}),
+    "thead": (frozenset(["thead", "tbody", "tfoot", "tr", "td", "th"]), TABLE_SCOPE),
+    "tbody": (frozenset(["thead", "tbody", "tfoot", "tr", "td", "th"]), TABLE_SCOPE),
+    "tfoot": (frozenset(["thead", "tbody", "tfoot", "tr", "td", "th"]), TABLE_SCOPE),
+})
+# for each tag, the scopes it bounds and the scopes that count it, so the
+# parser can keep a count of what each scope can reach as elements open
+# and close
+SCOPE_BOUNDS = {}
+SCOPE_COUNTS = {}
+for closes, scope in set(AUTO_CLOSE.values()):
+    for tag in scope:
+        SCOPE_BOUNDS.setdefault(tag, []).append(scope)
+    for tag in closes:
+        SCOPE_COUNTS.setdefault(tag, []).append(scope)
 
 class HTMLParser:
-    SELF_CLOSING_TAGS = [
+    SELF_CLOSING_TAGS = frozenset([
         "area", "base", "br", "col", "embed", "hr", "img", "input",
         "link", "meta", "param", "source", "track", "wbr",
-    ]
+    ])
 
-    HEAD_TAGS = [
+    HEAD_TAGS = frozenset([
         "base", "basefont", "bgsound", "noscript",
         "link", "meta", "title", "style", "script",
-    ]
+    ])
 
-    def __init__(self, body):
+    # tokens that don't imply a <body> when only <html> is open
+    HTML_CHILD_TAGS = frozenset(["head", "body", "/html"])
+    # tokens that don't imply </head> when <head> is open
+    HEAD_CONTENT_TAGS = HEAD_TAGS | {"/head"}
+
+    PREFETCH_RELS = frozenset(["stylesheet", "preload", "prefetch"])
+
+    def __init__(self, body = ""):
         self.body = body
         self.unfinished = []
-        self.out = []
-        self.pos = 0
+        # how many of each tag are in self.unfinished
+        self.open_counts = {}
+        # per scope in AUTO_CLOSE, how many of each tag it closes are open
+        # above the nearest element bounding it, and the counts each open
+        # boundary has hidden
+        self.scope_counts = {scope: {} for _, scope in AUTO_CLOSE.values()}
+        self.hidden_counts = []
+        self.text = []
+        # while self.body starts with an unfinished tag or comment: how much
+        # of it has been searched already, what in a new chunk could finish
+        # it, and chunks held back because they had none of that
+        self.searched = 0
+        self.waiting_for = ()
+        self.pending = []
+        # hrefs of <link>s worth fetching ahead of time
+        self.links = []
+        self.node_count = 0
 
-    def peek(self, n = 0):
-        if self.pos + n >= len(self.body):
-            return '\0'
-        else:
-            return self.body[self.pos + n]
+    def parse(self):
+        with tracer.span("parse", size = len(self.body)):
+            self.tokenize(final = True)
+            return self.finish()
 
-    def advance(self, n = 1):
-        self.pos += n
-        return self.peek()
+    def feed(self, chunk):
+        # incremental interface -- consume whatever complete tokens are
+        # available and keep any partial token around for the next chunk
+        if self.waiting_for:
+            # a long comment or tag arriving in pieces: put chunks aside until
+            # one could finish it, so it isn't copied and searched every time
+            tail = (self.body[-3:] + "".join(self.pending[-3:]))[-3:] + chunk
+            if not any(token in tail for token in self.waiting_for):
+                self.pending.append(chunk)
+                return
+            self.join_pending()
+        self.body = self.body + chunk if self.body else chunk
+        with tracer.span("parse", size = len(chunk)):
+            self.tokenize(final = False)
 
-    def starts_comment(self):
-        if self.peek() == '<' and self.peek(1) == '!' and \
-           self.peek(2) == '-' and self.peek(3) == '-':
-            return True
-        return False
+    def join_pending(self):
+        if self.pending:
+            self.body = "".join([self.body] + self.pending)
+            self.pending.clear()
+            # held-back chunks had nothing that could finish the token
+            self.searched = max(self.searched, len(self.body) - 3)
 
-    def ends_comment(self):
-        if self.peek() == '-' and self.peek(1) == '-' and self.peek(2) == '>':
-            return True
-        return False
+    def close(self):
+        self.join_pending()
+        with tracer.span("parse"):
+            self.tokenize(final = True)
+            return self.finish()
 
-    def parse(self):
-        state = HTMLParseState.InText
-        text = ""
-        buf = ""
-        comment_found = 0
-        i = 0;
-        c = self.peek()
-        while c != '\0':
-            if self.starts_comment():
-                print("starts comment")
-                c = self.advance(2)
-                while c != '\0' and not self.ends_comment():
-                    c = self.advance()
-                if c == '\0':
-                    break
-
-            if state == HTMLParseState.InText:
-                if c == "<":
-                    state = HTMLParseState.InTag
-                    self.add_text(text)
-                    text = ""
-                elif c == "&":
-                    state = HTMLParseState.InEntity
-                else:
-                    text += c
+    def tree(self):
+        # root of the partially built tree, for painting before the body is complete
+        return self.unfinished[0] if self.unfinished else None
 
-            elif state == HTMLParseState.InEntity:
-                if c == ";":
-                    state = HTMLParseState.InText
-                    text += entity(buf)
-                    buf = ""
-                else:
-                    buf += c
-                    
-            elif state == HTMLParseState.InTag:
-                if c == ">":
-                    state = HTMLParseState.InText
+    def tokenize(self, final):
+        # bulk tokenizer -- finds the end of each run of text, tag, character
+        # reference or comment with str.find and builds strings from slices
+        body = self.body
+        text = self.text
+        pos = 0
+        # only good for the token at the start of the body
+        searched = self.searched
+        self.searched = 0
+        self.waiting_for = ()
+        while True:
+            match = TEXT_DELIMITERS.search(body, pos)
+            if not match:
+                text.append(body[pos:])
+                pos = len(body)
+                break
+
+            start = match.start()
+            text.append(body[pos:start])
+            if body.startswith("<!--", start):
+                pos = self.skip_comment(start, searched)
+            elif match.group() == "<":
+                buf, pos = self.scan_until(">", start + 1, searched)
+                if pos >= 0 or final:
+                    self.add_text("".join(text))
+                    text.clear()
+                if pos >= 0:
                     self.add_tag(buf)
-                    buf = ""
-                else:
-                    buf += c
+            else:
+                value, pos = char_ref(body, start, final)
+                if pos >= 0:
+                    text.append(value)
+
+            if pos < 0:
+                # incomplete token -- wait for more input unless this is the end
+                pos = len(body) if final else start
+                self.wait(body, start)
+                break
+            searched = 0
 
-            c = self.advance()
+        self.body = body[pos:]
+        if final:
+            self.add_text("".join(text))
+            text.clear()
 
-        if state == HTMLParseState.InText and text:
-            self.add_text(text)
+    def wait(self, body, start):
+        # the tag or comment at body[start] is unfinished. Searching it again
+        # can start a little before its end, unless it's a tag with a comment
+        # inside, which scan_until has to take from the top
+        if body.startswith("<!--", start):
+            self.waiting_for = ("-->",)
+        elif body[start] == "<" and body.find("<!--", start) < 0:
+            self.waiting_for = (">", "<!--")
+        else:
+            return
+        self.searched = max(len(body) - start - 3, 0)
 
-        return self.finish()
+    def skip_comment(self, pos, searched = 0):
+        # pos points at "<!--"; the closing "-->" may overlap the opening dashes
+        end = self.body.find("-->", max(pos + 2, searched))
+        if end < 0:
+            return -1
+        return end + 3
 
-    def get_attributes(self, text):
-        parts = text.split()
-        tag = parts[0].casefold()
-        attributes = {}
-        for attrpair in parts[1:]:
-            if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                attributes[key.casefold()] = value
+    def scan_until(self, terminator, pos, searched = 0):
+        # collect everything up to the terminator, dropping any comments on
+        # the way; nothing before `searched` is a terminator or a comment
+        body = self.body
+        pieces = []
+        while True:
+            start = max(pos, searched)
+            end = body.find(terminator, start)
+            comment = body.find("<!--", start, end if end >= 0 else len(body))
+            if comment >= 0:
+                pieces.append(body[pos:comment])
+                pos = self.skip_comment(comment)
+                if pos < 0:
+                    return "", -1
+            elif end < 0:
+                return "", -1
             else:
-                attributes[attrpair.casefold()] = ""
+                pieces.append(body[pos:end])
+                return "".join(pieces), end + 1
 
-        return tag, attributes
+    def split_tag(self, text):
+        # the tag name and the raw attribute text, which is only parsed if
+        # someone reads the element's attributes
+        match = TAG_NAME.match(text)
+        return name(match.group(1)), text[match.end():]
 
     def add_text(self, text):
         if text.isspace() or not text: return
@@ -129,75 +279,216 @@ class HTMLParser:
         parent = self.unfinished[-1]
         node = Text(text, parent)
         parent.children.append(node)
+        self.node_count += 1
 
     def add_tag(self, tag):
-        tag, attributes = self.get_attributes(tag)
-        if tag.startswith("!"): return
+        tag, attribute_text = self.split_tag(tag)
+        if tag.startswith("!") or tag in ("", "/"): return
         self.implicit_tags(tag)
 
         if tag.startswith("/"):
-            if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        elif tag in self.SELF_CLOSING_TAGS:
+            # close the nearest open element with this tag, and anything left
+            # open inside it; stray close tags are ignored, and so are </body>
+            # and </html>, so that anything after them still lands in the body
+            tag = tag[1:]
+            if tag in ("body", "html") or not self.open_counts.get(tag): return
+            while self.pop().tag != tag:
+                pass
+            return
+
+        if tag in AUTO_CLOSE:
+            closes, scope = AUTO_CLOSE[tag]
+            while any(self.scope_counts[scope].get(closed) for closed in closes):
+                self.close_nearest(closes, scope)
+
+        if tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
-            node = Element(tag, attributes, parent)
+            node = Element(tag, None, parent, attribute_text)
+            node.children = NO_CHILDREN
             parent.children.append(node)
+            self.node_count += 1
+            if tag == "link":
+                attributes = node.attributes
+                rels = attributes.get("rel", "").casefold().split()
+                if "href" in attributes and any(rel in self.PREFETCH_RELS for rel in rels):
+                    self.links.append(attributes["href"])
         else:
+            # attach open elements right away so the partial tree is always whole
             parent = self.unfinished[-1] if self.unfinished else None
-            node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            node = Element(tag, None, parent, attribute_text)
+            if parent: parent.children.append(node)
+            self.push(node)
+            self.node_count += 1
+
+    def push(self, node):
+        tag = node.tag
+        self.unfinished.append(node)
+        self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+        scope_counts = self.scope_counts
+        # a boundary starts its scopes' counts afresh until it closes
+        for scope in SCOPE_BOUNDS.get(tag, ()):
+            self.hidden_counts.append(scope_counts[scope])
+            scope_counts[scope] = {}
+        for scope in SCOPE_COUNTS.get(tag, ()):
+            counts = scope_counts[scope]
+            counts[tag] = counts.get(tag, 0) + 1
+
+    def pop(self):
+        node = self.unfinished.pop()
+        tag = node.tag
+        self.open_counts[tag] -= 1
+        scope_counts = self.scope_counts
+        for scope in SCOPE_COUNTS.get(tag, ()):
+            scope_counts[scope][tag] -= 1
+        for scope in reversed(SCOPE_BOUNDS.get(tag, ())):
+            scope_counts[scope] = self.hidden_counts.pop()
+        if not node.children:
+            node.children = NO_CHILDREN
+        return node
+
+    def close_nearest(self, closes, scope):
+        # pop back through the nearest open element in closes. scope_counts
+        # says there is one before anything in scope, so the walk only
+        # passes elements that get popped
+        i = len(self.unfinished) - 1
+        while self.unfinished[i].tag not in closes:
+            i -= 1
+        while len(self.unfinished) > i:
+            self.pop()
 
     def finish(self):
         if not self.unfinished:
             self.implicit_tags(None)
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+        root = self.unfinished[0]
+        self.unfinished.clear()
+        self.open_counts.clear()
+        self.scope_counts = {scope: {} for scope in self.scope_counts}
+        self.hidden_counts.clear()
+        tracer.count("nodes parsed", self.node_count)
+        return root
+
+    def insertion_mode(self):
+        # only the first two levels of the stack matter, so this is O(1)
+        # however deeply the current element is nested
+        depth = len(self.unfinished)
+        if depth == 0:
+            return InsertionMode.BeforeHtml
+        elif depth == 1:
+            return InsertionMode.BeforeBody
+        elif depth == 2 and self.unfinished[1].tag == "head":
+            return InsertionMode.InHead
+        return InsertionMode.InBody
 
     def implicit_tags(self, tag):
+        if len(self.unfinished) > 2:
+            # the common case: in the body, where nothing is implied
+            return
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            mode = self.insertion_mode()
+            if mode is InsertionMode.BeforeHtml and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] \
-                 and tag not in ["head", "body", "/html"]:
+            elif mode is InsertionMode.BeforeBody and tag not in self.HTML_CHILD_TAGS:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and \
-                 tag not in ["/head"] + self.HEAD_TAGS:
+            elif mode is InsertionMode.InHead and tag not in self.HEAD_CONTENT_TAGS:
                 self.add_tag("/head")
             else:
                 break
 
-def entity(buf):
-    if buf == "lt":
-        return "<"
-    elif buf == "gt":
-        return ">"
-    elif buf == "amp":
-        return "&"
-    elif buf == "ndash":
-        return "-"
-    elif buf == "copy":
-        return "©"
-    elif buf == "quot":
-        return '"'
-    elif buf == "shy":
-        return "\N{soft hyphen}"
-    else:
-        return ""
+def name(raw):
+    # tag and attribute names are casefolded and interned, so every element
+    # shares one copy of "div" and comparisons against it are cheap
+    folded = NAMES.get(raw)
+    if folded is None:
+        folded = sys.intern(raw.casefold())
+        if len(NAMES) < MAX_NAMES:
+            NAMES[raw] = folded
+    return folded
+
+def parse_attributes(text):
+    # single pass over a tag's attribute text; values come back without
+    # their quotes and with character references decoded, and the first of
+    # any duplicate names wins
+    attributes = {}
+    for match in ATTRIBUTE.finditer(text):
+        key, double, single, bare = match.groups()
+        key = name(key)
+        if key in attributes: continue
+        if double is not None:
+            value = double
+        elif single is not None:
+            value = single
+        else:
+            value = bare or ""
+        attributes[key] = attribute_value(value) if "&" in value else value
+    return attributes
+
+def attribute_value(value):
+    # an attribute value with its character references decoded
+    out = []
+    pos = 0
+    while True:
+        amp = value.find("&", pos)
+        if amp < 0:
+            out.append(value[pos:])
+            return "".join(out)
+        out.append(value[pos:amp])
+        text, pos = char_ref(value, amp, True, True)
+        out.append(text)
+
+def char_ref(body, pos, final, in_attribute = False):
+    # decode the character reference whose "&" is at body[pos], returning
+    # the text and the position after it. A bare "&" comes back as itself,
+    # and (None, -1) means the body ends before we can tell what it is.
+    # In attribute values a legacy name without its ";" followed by a
+    # letter, digit or "=" stays literal, so query strings like "?a=1&copy=2"
+    # survive.
+    match = CHAR_REFERENCE.match(body, pos + 1)
+    end = match.end() if match else pos + 1
+    if end >= len(body) and not final and not (match and match.group(2)):
+        return None, -1
+    if not match:
+        return "&", pos + 1
+
+    name, semicolon = match.groups()
+    if name[0] == "#":
+        is_hex = name[1:2] in ("x", "X")
+        digits = name[2:] if is_hex else name[1:]
+        if not digits:
+            return "&", pos + 1
+        # skip converting huge numbers, which is slow and limited in length
+        digits = digits.lstrip("0")
+        if len(digits) > MAX_DIGITS:
+            return numeric_ref(0x110000), end
+        return numeric_ref(int(digits or "0", 16 if is_hex else 10)), end
+    if semicolon and name in ENTITIES:
+        return ENTITIES[name], end
+    # legacy names work without the ";", matching the longest prefix
+    for n in range(min(len(name), LEGACY_LENGTH), 1, -1):
+        if name[:n] in LEGACY_ENTITIES:
+            if in_attribute:
+                after = body[pos + 1 + n:pos + 2 + n]
+                if after == "=" or (after.isascii() and after.isalnum()):
+                    return "&", pos + 1
+            return ENTITIES[name[:n]], pos + 1 + n
+    return "&", pos + 1
+
+def numeric_ref(code):
+    if code in NUMERIC_REPLACEMENTS:
+        return NUMERIC_REPLACEMENTS[code]
+    if code == 0 or code > 0x10FFFF or 0xD800 <= code <= 0xDFFF:
+        return "\N{replacement character}"
+    return chr(code)
 
 def print_tree(node, indent = 0):
-    space = "." * indent
-    print(f"{space}{node}")
-    for child in node.children:
-        print_tree(child, indent + 1)
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        space = "." * indent
+        print(f"{space}{node}")
+        stack.extend([(child, indent + 1) for child in reversed(node.children)])
 
 if __name__ == "__main__":
     import sys
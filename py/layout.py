@@ -1,41 +1,206 @@
-import tkinter
-import tkinter.font
+import sys
+from bisect import bisect_right
+from itertools import accumulate, islice
+from operator import add
 
 from html import Text, Element
-from draw import DrawText, DrawRect
+from draw import DisplayList
 
+from fonts import make_backend
+from lru import LRU
+from tracing import tracer
 from constants import *
 
 FONTS = {}
+# per-font ascent, descent, linespace and space width, keyed like FONTS
+FONT_METRICS = {}
+# small integer ids for fonts, so display lists can store an id per word
+FONT_TABLE = []
+FONT_IDS = {}
 
-BLOCK_ELEMENTS = [
+# number of (font, word) widths kept by WORD_WIDTHS
+WORD_CACHE_SIZE = 200_000
+
+BLOCK_ELEMENTS = frozenset([
     "html", "body", "article", "section", "nav", "aside",
     "h1", "h2", "h3", "h4", "h5", "h6", "hgroup", "header",
     "footer", "address", "p", "hr", "pre", "blockquote",
     "ol", "ul", "menu", "li", "dl", "dt", "dd", "figure",
     "figcaption", "main", "div", "table", "form", "fieldset",
     "legend", "details", "summary"
-]
+])
+
+# where fonts come from: Tk by default, or a headless table-driven backend
+font_backend = make_backend()
+
+def set_font_backend(backend):
+    # switch backends by name or instance; cached fonts and widths belong to
+    # the old one, so they are dropped
+    global font_backend
+    font_backend = make_backend(backend) if isinstance(backend, str) or backend is None else backend
+    FONTS.clear()
+    FONT_METRICS.clear()
+    FONT_TABLE.clear()
+    FONT_IDS.clear()
+    WORD_WIDTHS.clear()
 
 def get_font(family, size, weight, style):
     key = (family, size, weight, style)
     if key not in FONTS:
-        font = tkinter.font.Font(
-            family = family,
-            size = size, weight = weight, slant = style
-        )
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
+        tracer.count("fonts created")
+        FONTS[key] = font_backend.create(family, size, weight, style)
+    else:
+        tracer.count("font cache hits")
+    return FONTS[key]
+
+def get_font_id(key):
+    if key not in FONT_IDS:
+        FONT_IDS[key] = len(FONT_TABLE)
+        FONT_TABLE.append(get_font(*key))
+    return FONT_IDS[key]
+
+class FontMetrics:
+    def __init__(self, font):
+        metrics = font.metrics()
+        self.ascent = metrics["ascent"]
+        self.descent = metrics["descent"]
+        self.linespace = metrics["linespace"]
+        self.space = font.measure(" ")
+
+def get_metrics(key):
+    if key not in FONT_METRICS:
+        FONT_METRICS[key] = FontMetrics(get_font(*key))
+    return FONT_METRICS[key]
+
+class WordWidths(LRU):
+    # word widths keyed by (font key, word)
+    def __init__(self, capacity = WORD_CACHE_SIZE):
+        super().__init__(capacity)
+
+    def measure(self, key, words):
+        # widths of all the words in `words`, measuring the unknown ones in one batch
+        widths = self.entries
+        missing = []
+        for word in words:
+            entry = (key, word)
+            if entry in widths:
+                widths.move_to_end(entry)
+            else:
+                missing.append(word)
+
+        self.misses += len(missing)
+        self.hits += len(words) - len(missing)
+        tracer.count("word cache hits", len(words) - len(missing))
+        if not missing:
+            return [widths[(key, word)] for word in words]
+
+        missing = list(dict.fromkeys(missing))
+        tracer.count("words measured", len(missing))
+        measured = dict(zip(missing, font_backend.measure_many(get_font(*key), missing)))
+        # read the batch back before evicting, which may drop some of it
+        # when one call has more distinct words than the cache holds
+        result = [measured[word] if word in measured else widths[(key, word)] for word in words]
+        for word, w in measured.items():
+            self.remember((key, word), w)
+        return result
+
+WORD_WIDTHS = WordWidths()
+
+# text whose width, over its length, is a font's average character width
+SAMPLE_TEXT = "The quick brown fox jumps over the lazy dog"
+# the font blocks start out in, which estimates assume throughout
+DEFAULT_FONT = ("Times", 12, "normal", "roman")
+
+# markers in BlockLayout.items for breaks forced by the markup
+LINE_BREAK = "<br>"
+PARAGRAPH_BREAK = "</p>"
+
+class WordRun:
+    # measured words between two forced breaks, as columns, plus where each
+    # word would start and end if the run were one endless line; the words
+    # that fit on a line are then a binary search away
+    __slots__ = ("words", "font_ids", "widths", "advances", "ascents", "descents",
+                 "linespaces", "starts", "ends", "sorted")
+
+    def __init__(self, words, font_ids, widths, advances, ascents, descents, linespaces):
+        self.words = words
+        self.font_ids = font_ids
+        self.widths = widths
+        # width plus the space after the word
+        self.advances = advances
+        self.ascents = ascents
+        self.descents = descents
+        self.linespaces = linespaces
+        self.starts = list(accumulate(advances, initial = 0))
+        self.ends = list(map(add, self.starts, widths))
+        # negative font sizes make negative widths, and then ends isn't sorted
+        self.sorted = min(self.widths) >= 0 and min(self.advances) >= 0
+
+    def __len__(self):
+        return len(self.words)
+
+def classify(tree):
+    # annotate every element once with what layout asks of it: whether it
+    # is a block, whether any child is, and how its children group into
+    # anonymous blocks -- exercise 5-5: runs of text-like children are laid
+    # out together, block children each get their own layout
+    if isinstance(tree, Element):
+        tree.is_block = tree.tag in BLOCK_ELEMENTS
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Text): continue
+        groups = []
+        buf = []
+        for child in node.children:
+            if isinstance(child, Element):
+                child.is_block = child.tag in BLOCK_ELEMENTS
+                if child.is_block:
+                    if buf:
+                        groups.append(buf)
+                        buf = []
+                    groups.append([child])
+                    continue
+            buf.append(child)
+        node.has_block_children = len(groups) > 0
+        if node.has_block_children:
+            if buf: groups.append(buf)
+            node.groups = groups
+        else:
+            # all text-like, so one group; share the children list
+            node.groups = (node.children,) if node.children else ()
+        stack.extend(node.children)
 
 def paint_tree(layout_object, display_list):
-    display_list.extend(layout_object.paint())
-    for child in layout_object.children:
-        paint_tree(child, display_list)
+    # pre-order walk with an explicit stack, so deeply nested pages can't
+    # hit the recursion limit. Blocks with only an estimated height have
+    # nothing laid out to paint
+    stack = [layout_object]
+    while stack:
+        obj = stack.pop()
+        if obj.estimate is not None: continue
+        obj.paint(display_list)
+        stack.extend(reversed(obj.children))
+
+def text_size(nodes):
+    # characters of text under nodes, and how many paragraphs they're in
+    chars = 0
+    paragraphs = 0
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Text):
+            chars += len(node.text)
+        else:
+            if node.tag == "p":
+                paragraphs += 1
+            stack.extend(node.children)
+    return chars, paragraphs
 
 class DocumentLayout:
     def __init__(self, node, x1, y1, x2, y2):
         self.node = node
+        classify(node)
         self.parent = None
         self.previous = None
         self.children = []
@@ -43,19 +208,161 @@ class DocumentLayout:
         self.y1 = y1
         self.x2 = x2
         self.y2 = y2
-
-    def layout(self):
-        child = BlockLayout([self.node], self, None)
-        self.children.append(child)
-
-        self.width = self.x2 - self.x1 - 2 * HSTEP
+        # the document itself is always laid out; see BlockLayout.estimate
+        self.estimate = None
+        # for lazy layout: the blocks from the root down to the one whose
+        # children are laid out on demand (the body, usually), that block,
+        # and how many of its children are laid out for real
+        self.chain = None
+        self.container = None
+        self.laid_out = 0
+
+    def layout(self, bottom = None):
+        with tracer.span("layout", lazy = bottom is not None):
+            self.layout_children(bottom)
+
+    def layout_children(self, bottom = None):
+        for _ in self.layout_steps(bottom):
+            pass
+
+    def layout_steps(self, bottom = None):
+        # lay out the document, yielding each block as soon as it is finished
+        # (children before parents) so a caller can paint what's ready
+        # the block tree is built once and reused when only the size changes.
+        # Given a bottom, layout is lazy: top-level blocks starting below it
+        # only get an estimated height until extend() reaches them
+        if not self.children:
+            self.children.append(BlockLayout([self.node], self, None))
+        child = self.children[0]
+
+        self.width = self.content_width()
         self.x = HSTEP + self.x1
         self.y = VSTEP + self.y1
-        child.layout()
+        if bottom is None:
+            if self.container:
+                for block in self.container.children:
+                    block.estimate = None
+            self.container = None
+            yield from child.layout_steps()
+        else:
+            yield from self.lazy_steps(child, bottom)
         self.height = child.height
 
-    def paint(self):
-        return []
+    def lazy_steps(self, root, bottom):
+        # follow the last child down while it holds most of the text, laying
+        # out the blocks before it (like <head>) for real
+        chain = [root]
+        root.layout_self()
+        while chain[-1].mode == "block" and chain[-1].children:
+            block = chain[-1]
+            last = block.children[-1]
+            if last.mode != "block": break
+            if not last.children:
+                last.build_children()
+            if 2 * self.text_size(last)[0] <= self.text_size(block)[0]: break
+            for child in block.children[:-1]:
+                yield from child.layout_steps()
+            last.layout_self()
+            chain.append(last)
+        self.chain = chain
+        self.container = chain[-1] if chain[-1].mode == "block" else None
+
+        if self.container:
+            self.laid_out = 0
+            yield from self.extend_steps(bottom)
+            children = self.container.children
+            for block in children[:self.laid_out]:
+                block.estimate = None
+            char_width = WORD_WIDTHS.measure(DEFAULT_FONT, [SAMPLE_TEXT])[0] / len(SAMPLE_TEXT)
+            metrics = get_metrics(DEFAULT_FONT)
+            line_height = 1.25 * (metrics.ascent + metrics.descent)
+            for block in children[self.laid_out:]:
+                block.estimate = block.height = \
+                    self.estimate_height(block, char_width, line_height)
+        for block in reversed(chain):
+            block.layout_height()
+            yield block
+
+    def extend_steps(self, bottom):
+        # lay out the container's children for real, in order, as long as
+        # they start above bottom
+        children = self.container.children
+        while self.laid_out < len(children):
+            block = children[self.laid_out]
+            if block.previous:
+                top = block.previous.y + block.previous.height
+            else:
+                top = self.container.y
+            if top > bottom: break
+            yield from block.layout_steps()
+            self.laid_out += 1
+
+    def extend(self, bottom, anchor):
+        # lay out more of a lazily laid out document, down to bottom. Returns
+        # the top-level blocks laid out, for painting, and how far the real
+        # heights replacing their estimates moved content below anchor
+        if self.complete: return [], 0
+        start = self.laid_out
+        with tracer.span("layout", lazy = True):
+            for _ in self.extend_steps(bottom):
+                pass
+            for block in reversed(self.chain):
+                block.layout_height()
+            self.height = self.children[0].height
+        blocks = self.container.children[start:self.laid_out]
+        shift = 0
+        for block in blocks:
+            if block.y < anchor:
+                shift += block.height - block.estimate
+            block.estimate = None
+        return blocks, shift
+
+    @property
+    def complete(self):
+        # whether every block is laid out for real
+        return self.container is None or self.laid_out == len(self.container.children)
+
+    def text_size(self, block):
+        # from the children when they're built, so each node is counted once
+        if block.text_size is None:
+            if block.mode == "block" and block.children:
+                sizes = [self.text_size(child) for child in block.children]
+                block.text_size = (sum([chars for chars, _ in sizes]),
+                                   sum([paragraphs for _, paragraphs in sizes]))
+            else:
+                block.text_size = text_size(block.nodes)
+        return block.text_size
+
+    def estimate_height(self, block, char_width, line_height):
+        # a block we haven't laid out as its text in lines of the default
+        # font, plus the gap after each paragraph
+        chars, paragraphs = self.text_size(block)
+        lines = -(-chars * char_width // self.width)
+        return lines * line_height + paragraphs * VSTEP
+
+    def content_width(self):
+        # every block is as wide as the document
+        return self.x2 - self.x1 - 2 * HSTEP
+
+    def inline_blocks(self):
+        # build the whole block tree, which needs no sizes, and return the
+        # blocks that do line breaking, in document order
+        if not self.children:
+            self.children.append(BlockLayout([self.node], self, None))
+        blocks = []
+        stack = [self.children[0]]
+        while stack:
+            block = stack.pop()
+            if block.mode == "block":
+                if not block.children:
+                    block.build_children()
+            else:
+                blocks.append(block)
+            stack.extend(reversed(block.children))
+        return blocks
+
+    def paint(self, display_list):
+        pass
 
     def __repr__(self):
         return "DocumentLayout()"
@@ -70,25 +377,64 @@ class BlockLayout:
         self.y = None
         self.width = None
         self.height = None
-        self.display_list = []
+        # this block's positioned words, filled in by break_run() in inline mode
+        self.display_list = None
+        # runs of measured words and the forced breaks between them,
+        # independent of the width
+        self.items = None
+        # (width, height, line boxes, fonts) broken by a worker process
+        self.prebroken = None
+        # when set, break_run() records words here instead of drawing them, as
+        # columns of x, line baseline, font id and word
+        self.line_boxes = None
+        self.mode = self.layout_mode()
+        # the height this block was given without being laid out, by lazy
+        # layout, or None once it has been
+        self.estimate = None
+        # (characters, paragraphs) of text under it, for estimating
+        self.text_size = None
 
         # specific styles
         self.family = "Times"
         self.pre = False
+        self.size = 12
+        self.weight = "normal"
+        self.style = "roman"
 
     def layout_mode(self):
-        if isinstance(self.nodes[0], Text):
+        # reads the flags classify() left on the node; BlockLayout keeps the
+        # answer in self.mode
+        node = self.nodes[0]
+        if isinstance(node, Text):
             return "inline"
-        elif any([isinstance(child, Element) and \
-                  child.tag in BLOCK_ELEMENTS
-                  for child in self.nodes[0].children]):
+        elif node.has_block_children:
             return "block"
-        elif self.nodes[0].children:
+        elif node.children:
             return "inline"
         else:
             return "block"
-        
+
     def layout(self):
+        for _ in self.layout_steps():
+            pass
+
+    def layout_steps(self):
+        # lay out this block and everything below it without recursing: each
+        # block is visited once on the way down (position, width, lines) and
+        # once on the way back up (height), in the same order as a recursive
+        # walk, and is yielded once its height is known
+        stack = [(self, False)]
+        while stack:
+            block, finished = stack.pop()
+            if finished:
+                block.layout_height()
+                yield block
+            else:
+                block.layout_self()
+                stack.append((block, True))
+                stack.extend([(child, False) for child in reversed(block.children)])
+
+    def layout_self(self):
         self.x = self.parent.x
         self.width = self.parent.width
 
@@ -97,103 +443,140 @@ class BlockLayout:
         else:
             self.y = self.parent.y
 
-        mode = self.layout_mode()
-        if mode == "block":
-            previous = None
-            for node in self.nodes:
-                in_sequence = False
-                children = []
-                buf = []
-                for child in node.children:
-                    # handle anonymous blocks -- exercise 5-5
-                    # group children into lists of text-like elements and individual others
-                    # add the lists of elements to block layouts together instead of
-                    # individually in their own layouts
-                    if isinstance(child, Element) and child.tag in BLOCK_ELEMENTS:
-                        # container-like element
-                        if in_sequence:
-                            children.append(buf)
-                            buf = []
-                            in_sequence = False
-                        children.append([child])
-                    else:
-                        # text-like element or just text
-                        in_sequence = True
-                        buf.append(child)
-
-                if buf: children.append(buf)
-
-                # loop over each sequence of children, lay them out together
-                for child_list in children:
-                    for child in child_list:
-                        if isinstance(child, Element):
-                            tag, attrs = child.tag, child.attributes
-                            if tag == "head": continue # don't include head in layout
-                            if tag == "nav" and "id" in attrs and attrs["id"] == '"toc"':
-                                # lay out table of contents -- add text right before it in a special container
-                                toc_node = Element("nav", attributes = {"id": '"toc_text"'}, parent = None)
-                                toc_text = Text("Table of Contents", parent = toc_node)
-                                toc_node.children.append(toc_text)
-
-                                next = BlockLayout([toc_node], self, previous)                        
-                                self.children.append(next)
-                                previous = next
-
-                                next.children.append(BlockLayout([toc_text], next, None))
-
-                    next = BlockLayout(child_list, self, previous)
-                    self.children.append(next)
-                    previous = next
+        if self.mode == "block":
+            if not self.children:
+                self.build_children()
+        elif self.prebroken and self.prebroken[0] == self.width:
+            _, height, line_boxes, fonts = self.prebroken
+            self.place_lines(line_boxes, fonts)
+            self.cursor_y = height
         else:
-            self.cursor_x = 0
-            self.cursor_y = 0
-            self.weight = "normal"
-            self.style = "roman"
-            self.size = 12
-
-            self.line = []
-            for node in self.nodes:
-                self.recurse(node)
-            self.flush()
-
-        for child in self.children:
-            child.layout()
+            if self.items is None:
+                self.collect()
+            self.break_lines()
 
-        if mode == "block":
+    def layout_height(self):
+        # children are all laid out by now
+        if self.mode == "block":
             self.height = sum([
                 child.height for child in self.children])
         else:
             self.height = self.cursor_y
 
-    def paint(self):
-        cmds = []
+    def build_children(self):
+        previous = None
+        for node in self.nodes:
+            if isinstance(node, Text): continue
+            # loop over each sequence of children (see classify), lay them out together
+            for child_list in node.groups:
+                for child in child_list:
+                    if isinstance(child, Element):
+                        tag = child.tag
+                        if tag == "head": continue # don't include head in layout
+                        # attributes are parsed when first read, so only for navs
+                        if tag == "nav" and child.attributes.get("id") == "toc":
+                            # lay out table of contents -- add text right before it in a special container
+                            toc_node = Element("nav", attributes = {"id": "toc_text"}, parent = None)
+                            toc_text = Text("Table of Contents", parent = toc_node)
+                            toc_node.children.append(toc_text)
+                            classify(toc_node)
+
+                            next = BlockLayout([toc_node], self, previous)                        
+                            self.children.append(next)
+                            previous = next
+
+                            next.children.append(BlockLayout([toc_text], next, None))
+
+                next = BlockLayout(child_list, self, previous)
+                self.children.append(next)
+                previous = next
+
+    def collect(self):
+        # walk the inline content once, measuring every word; line breaking
+        # replays the result, so a change of width doesn't re-measure anything
+        self.words = []
+        # [font key, start, end] for each stretch of words in one font, and
+        # (word index, marker) for each forced break
+        self.spans = []
+        self.breaks = []
+        for node in self.nodes:
+            self.recurse(node)
+        words, spans, breaks = self.words, self.spans, self.breaks
+        self.words = self.spans = self.breaks = None
+
+        # measure all the words in one batch per font
+        by_font = {}
+        for key, start, end in spans:
+            by_font.setdefault(key, []).extend(words[start:end])
+        measured = {key: iter(WORD_WIDTHS.measure(key, font_words))
+                    for key, font_words in by_font.items()}
+
+        # then lay the measurements out as columns, a span at a time
+        font_ids = []
+        widths = []
+        spaces = []
+        ascents = []
+        descents = []
+        linespaces = []
+        for key, start, end in spans:
+            count = end - start
+            metrics = get_metrics(key)
+            widths.extend(islice(measured[key], count))
+            font_ids.extend([get_font_id(key)] * count)
+            spaces.extend([metrics.space] * count)
+            ascents.extend([metrics.ascent] * count)
+            descents.extend([metrics.descent] * count)
+            linespaces.extend([metrics.linespace] * count)
+        advances = list(map(add, widths, spaces))
+
+        # and cut them into runs at the forced breaks
+        if not breaks:
+            self.items = [WordRun(words, font_ids, widths, advances, ascents, descents, linespaces)]
+            return
+        self.items = []
+        start = 0
+        for end, marker in breaks + [(len(words), None)]:
+            if end > start:
+                self.items.append(WordRun(
+                    words[start:end], font_ids[start:end], widths[start:end], advances[start:end],
+                    ascents[start:end], descents[start:end], linespaces[start:end]))
+                start = end
+            if marker:
+                self.items.append(marker)
+
+    def break_lines(self):
+        # every run ends its last line, so a <br> has nothing left to do
+        self.display_list = DisplayList(FONT_TABLE)
+        self.cursor_y = 0
+        for item in self.items:
+            if item is PARAGRAPH_BREAK:
+                self.cursor_y += VSTEP
+            elif item is not LINE_BREAK:
+                self.break_run(item)
+
+    def paint(self, display_list):
         for node in self.nodes:
             if isinstance(node, Element):
                 tag = node.tag
-                attrs = node.attributes
 
                 if tag == "pre" :
                     x2, y2 = self.x + self.width, self.y + self.height
-                    rect = DrawRect(self.x, self.y, x2, y2, "lightgray")
-                    cmds.append(rect)
+                    display_list.rect(self.x, self.y, x2, y2, "lightgray")
 
                 if tag == "nav":
-                    if "class" in attrs and attrs["class"] == '"links"':
+                    attrs = node.attributes
+                    if "class" in attrs and attrs["class"] == "links":
                         # links bar
                         x2, y2 = self.x + self.width, self.y + self.height
-                        rect = DrawRect(self.x, self.y, x2, y2, "lightgray")
-                        cmds.append(rect)
+                        display_list.rect(self.x, self.y, x2, y2, "lightgray")
 
-                    if "id" in attrs and attrs["id"] == '"toc_text"':
+                    if "id" in attrs and attrs["id"] == "toc_text":
                         # table of contents
                         x2, y2 = self.x + self.width, self.y + self.height
-                        rect = DrawRect(self.x, self.y, x2, y2, "lightgray")
-                        cmds.append(rect)
+                        display_list.rect(self.x, self.y, x2, y2, "lightgray")
 
-            if self.layout_mode() == "inline":
-                for x, y, word, font in self.display_list:
-                    cmds.append(DrawText(x, y, word, font))
-        return cmds
+        if self.mode == "inline":
+            display_list.extend(self.display_list)
 
     def open_tag(self, tag):
         if tag == "i":
@@ -205,7 +588,7 @@ class BlockLayout:
         elif tag == "big":
             self.size += 4
         elif tag == "br":
-            self.flush()
+            self.breaks.append((len(self.words), LINE_BREAK))
         elif tag == "pre":
             self.pre = True
             self.family = "Courier New"
@@ -220,45 +603,104 @@ class BlockLayout:
         elif tag == "big":
             self.size -= 4
         elif tag == "p":
-            self.flush()
-            self.cursor_y += VSTEP
+            self.breaks.append((len(self.words), PARAGRAPH_BREAK))
         elif tag == "pre":
             self.pre = False
             self.family = "Times"
-            self.flush()
+            self.breaks.append((len(self.words), LINE_BREAK))
 
     def recurse(self, tree):
-        if isinstance(tree, Text):
-            for word in tree.text.split():
-                self.word(word)
+        # explicit-stack walk; an element is pushed a second time, as a
+        # closing marker, so close_tag runs after all of its children
+        stack = [(tree, False)]
+        while stack:
+            node, closing = stack.pop()
+            if isinstance(node, Text):
+                self.text(node.text)
+            elif closing:
+                self.close_tag(node.tag)
+            else:
+                self.open_tag(node.tag)
+                stack.append((node, True))
+                stack.extend([(child, False) for child in reversed(node.children)])
+
+    def text(self, text):
+        # the words of a text node all share the current font, so they extend
+        # the last span when it's in that font too
+        start = len(self.words)
+        self.words.extend(map(sys.intern, text.split()))
+        end = len(self.words)
+        if start == end: return
+        key = (self.family, self.size, self.weight, self.style)
+        spans = self.spans
+        if spans and spans[-1][2] == start and spans[-1][0] == key:
+            spans[-1][2] = end
+        else:
+            spans.append([key, start, end])
+
+    def break_run(self, run):
+        # greedy line breaking a line at a time: a word goes on the current
+        # line unless it would run past the edge, and a line always takes at
+        # least one word. The candidate break comes from a binary search on
+        # the running sums; the line's positions are then summed from zero,
+        # the same additions as placing the words one by one, and the break
+        # moved if the two disagree in the last place. Runs whose ends aren't
+        # sorted skip the search and extend each line a word at a time
+        width = self.width
+        starts, ends, widths, advances = run.starts, run.ends, run.widths, run.advances
+        ascents, descents = run.ascents, run.descents
+        n = len(run)
+        xs = []
+        baselines = []
+        i = 0
+        lines = 0
+        while i < n:
+            j = bisect_right(ends, width + starts[i], i + 1) if run.sorted else i + 1
+            line = list(accumulate(advances[i:j], initial = 0))
+            while j < n and line[-1] + widths[j] <= width:
+                line.append(line[-1] + advances[j])
+                j += 1
+            while j > i + 1 and line[-2] + widths[j - 1] > width:
+                line.pop()
+                j -= 1
+            # the last entry is where the next line's first word would have gone
+            line.pop()
+            xs.extend(line)
+            baseline = self.cursor_y + 1.25 * max(ascents[i:j])
+            baselines.extend([baseline] * (j - i))
+            self.cursor_y = baseline + 1.25 * max(descents[i:j])
+            lines += 1
+            i = j
+        tracer.count("lines flushed", lines)
+
+        if self.line_boxes is not None:
+            # breaking lines for another process, which positions the words
+            box_xs, box_baselines, font_ids, words = self.line_boxes
+            box_xs.extend(xs)
+            box_baselines.extend(baselines)
+            font_ids.extend(run.font_ids)
+            words.extend(run.words)
         else:
-            self.open_tag(tree.tag)
-            for child in tree.children:
-                self.recurse(child)
-            self.close_tag(tree.tag)
-
-    def word(self, word):
-        font = get_font(self.family, self.size, self.weight, self.style)
-        w = font.measure(word)
-        if self.cursor_x + w > self.width:
-            self.flush()
-        self.line.append((self.cursor_x, word, font))
-        self.cursor_x += w + font.measure(" ")
-
-    def flush(self):
-        if not self.line: return
-        metrics = [font.metrics() for x, word, font in self.line]
-        max_ascent = max([metric["ascent"] for metric in metrics])
-        baseline = self.cursor_y + 1.25 * max_ascent
-        for rel_x, word, font in self.line:
-            x = self.x + rel_x
-            y = self.y + baseline - font.metrics("ascent")
-            self.display_list.append((x, y, word, font))
-        self.cursor_x = 0
-        self.line = []
-        max_descent = max([metric["descent"] for metric in metrics])
-        self.cursor_y = baseline + 1.25 * max_descent
+            x, y = self.x, self.y
+            self.display_list.texts(
+                [x + rel_x for rel_x in xs],
+                [y + baseline - ascent for baseline, ascent in zip(baselines, ascents)],
+                run.words, run.font_ids, run.linespaces)
+
+    def place_lines(self, line_boxes, fonts):
+        # position words broken elsewhere, with the same arithmetic as
+        # break_run(); fonts maps the worker's font ids to (our font id, metrics)
+        xs, baselines, font_ids, words = line_boxes
+        fonts = [fonts[font_id] for font_id in font_ids]
+        x, y = self.x, self.y
+        self.display_list = DisplayList(FONT_TABLE)
+        self.display_list.texts(
+            [x + rel_x for rel_x in xs],
+            [y + baseline - metrics.ascent for baseline, (_, metrics) in zip(baselines, fonts)],
+            words,
+            [font_id for font_id, _ in fonts],
+            [metrics.linespace for _, metrics in fonts])
 
     def __repr__(self):
         return "BlockLayout[{}](x={}, y={}, width={}, height={}, node={})".format(
-            self.layout_mode(), self.x, self.y, self.width, self.height, self.node)
+            self.mode, self.x, self.y, self.width, self.height, self.nodes)
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+class LRU:
+    # entries kept in least- to most-recently used order and dropped from
+    # the old end once their total size passes the capacity. Sizes come from
+    # sizeof(), one per entry unless a subclass says otherwise (bytes).
+    # The caches built on this keep their own hit counts, since what counts
+    # as a hit (a Vary match, a decodable snapshot) is up to them.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def sizeof(self, value):
+        return 1
+
+    def recall(self, key):
+        # the value for key, now the most recently used, or None
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def remember(self, key, value):
+        self.forget(key)
+        size = self.sizeof(value)
+        if size > self.capacity:
+            return
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.capacity:
+            _, evicted = self.entries.popitem(last = False)
+            self.size -= self.sizeof(evicted)
+
+    def forget(self, key):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= self.sizeof(old)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "{}(entries={}, size={}, hits={}, misses={}, hit rate={:.1%})".format(
+            type(self).__name__, len(self.entries), self.size, self.hits, self.misses,
+            self.hit_rate())
@@ -0,0 +1,126 @@
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import layout
+from html import Text, Element
+from layout import BlockLayout, FONT_IDS, get_font_id, get_metrics, set_font_backend
+from tracing import tracer
+
+# documents with less inline text than this are laid out serially; shipping
+# them to workers would cost more than it saves
+PARALLEL_MIN_TEXT = 64 * 1024
+# characters of text in each batch of blocks sent to a worker
+BATCH_TEXT = 32 * 1024
+
+def flatten(nodes):
+    # the inline content under nodes as a flat, picklable list -- text
+    # strings, (tag,) for an open tag and None for its close -- and the
+    # number of characters of text in it
+    events = []
+    size = 0
+    stack = [(node, False) for node in reversed(nodes)]
+    while stack:
+        node, closing = stack.pop()
+        if isinstance(node, Text):
+            events.append(node.text)
+            size += len(node.text)
+        elif closing:
+            events.append(None)
+        else:
+            events.append((node.tag,))
+            stack.append((node, True))
+            stack.extend([(child, False) for child in reversed(node.children)])
+    return events, size
+
+def rebuild(events):
+    # inverse of flatten: detached nodes with just what line breaking reads
+    roots = []
+    open_elements = []
+    for event in events:
+        if event is None:
+            open_elements.pop()
+            continue
+        parent = open_elements[-1] if open_elements else None
+        if type(event) is str:
+            node = Text(event, parent)
+        else:
+            node = Element(event[0], {}, parent)
+        (parent.children if parent else roots).append(node)
+        if type(event) is tuple:
+            open_elements.append(node)
+    return roots
+
+def break_batch(batch):
+    # runs in a worker: break each block into line boxes, and say which font
+    # key is behind each of this process's font ids
+    results = []
+    for events, width in batch:
+        block = BlockLayout(rebuild(events), None, None)
+        block.width = width
+        block.line_boxes = (array("d"), array("d"), array("i"), [])
+        block.collect()
+        block.break_lines()
+        results.append((block.cursor_y, block.line_boxes))
+    keys = {font_id: key for key, font_id in FONT_IDS.items()}
+    return results, keys
+
+class LayoutPool:
+    # lays out a document with its line breaking spread over worker
+    # processes. Blocks only depend on each other through their heights, so
+    # the workers break lines independently and the ordinary serial layout
+    # pass then stacks the results, a prefix sum over block heights. Workers
+    # measure with the headless backend, so this only kicks in when we do too,
+    # which keeps the output identical to serial layout.
+    def __init__(self, workers = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(
+            self.workers, initializer = set_font_backend, initargs = ("headless",))
+
+    def layout(self, document):
+        if layout.font_backend.name == "headless":
+            with tracer.span("parallel line breaking", workers = self.workers):
+                self.break_lines(document)
+        document.layout()
+
+    def break_lines(self, document):
+        width = document.content_width()
+        blocks = [block for block in document.inline_blocks()
+                  if not (block.prebroken and block.prebroken[0] == width)]
+
+        # group the blocks into batches of roughly BATCH_TEXT characters
+        batches = []
+        batch_blocks = []
+        batch = []
+        batch_size = 0
+        total = 0
+        for block in blocks:
+            events, size = flatten(block.nodes)
+            batch.append((events, width))
+            batch_blocks.append(block)
+            batch_size += size
+            total += size
+            if batch_size >= BATCH_TEXT:
+                batches.append((batch_blocks, batch))
+                batch_blocks, batch, batch_size = [], [], 0
+        if batch:
+            batches.append((batch_blocks, batch))
+        if total < PARALLEL_MIN_TEXT:
+            return
+
+        results = self.executor.map(break_batch, [batch for _, batch in batches])
+        for (batch_blocks, _), (boxes, keys) in zip(batches, results):
+            fonts = {font_id: (get_font_id(key), get_metrics(key))
+                     for font_id, key in keys.items()}
+            for block, (height, line_boxes) in zip(batch_blocks, boxes):
+                block.prebroken = (width, height, line_boxes, fonts)
+        tracer.count("blocks broken in workers", len(blocks))
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,210 @@
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+from draw import DisplayList, DisplayIndex
+from layout import FONT_IDS, FONT_TABLE, get_font_id
+from lru import LRU
+from tracing import tracer
+
+# in-memory layer holds this many bytes of encoded snapshots
+MEMORY_SNAPSHOT_SIZE = 128 * 1024 * 1024
+# the on-disk store is trimmed back to this many bytes of compressed snapshots
+DISK_SNAPSHOT_SIZE = 512 * 1024 * 1024
+# snapshot files go here; an empty BROWSER_SNAPSHOT_PATH turns them off
+DISK_SNAPSHOT_PATH = os.environ.get("BROWSER_SNAPSHOT_PATH", os.path.join(
+    os.path.expanduser("~"), ".cache", "archermarx-browser", "snapshots"))
+
+# A snapshot is a header followed by raw arrays, in this order:
+#   font keys, strings    length-prefixed utf-8, "\0"-separated key fields
+#   kinds, lefts, tops, rights, bottoms, font ids, payload string indices
+#   index: short rows, tall rows, tops of the short rows
+# Arrays are stored in this machine's byte order; the header records the
+# item sizes so a snapshot from a different build is treated as a miss.
+MAGIC = b"BLS2"
+HEADER = struct.Struct("<4s8sIIIIIdd")
+ITEM_SIZES = bytes([array(code).itemsize for code in "bdiIl"]) + (
+    b"<" if struct.pack("=I", 1) == struct.pack("<I", 1) else b">") + b"\0\0"
+
+def snapshot_key(body_hash, width, backend):
+    return "{}-{}-{}".format(body_hash, width, backend)
+
+def body_hash(content_type):
+    # hash object to feed the page body into as it arrives; the same bytes
+    # lay out differently as HTML and as plain text
+    return hashlib.sha256(content_type.encode("utf-8") + b"\0")
+
+def encode_strings(strings):
+    data = [s.encode("utf-8") for s in strings]
+    return array("I", [len(d) for d in data]), b"".join(data)
+
+def decode_strings(lengths, data):
+    strings = []
+    pos = 0
+    for length in lengths:
+        strings.append(data[pos:pos + length].decode("utf-8"))
+        pos += length
+    return strings
+
+def encode(display_list, index):
+    # pack a display list and its index into bytes
+    font_keys = {font_id: key for key, font_id in FONT_IDS.items()}
+    font_ids = sorted(set(display_list.font_ids) - {-1})
+    keys = ["\0".join(str(part) for part in font_keys[i]) for i in font_ids]
+    font_map = dict(zip(font_ids, range(len(font_ids))))
+    font_map[-1] = -1
+
+    strings = {}
+    payloads = array("I", [strings.setdefault(s, len(strings)) for s in display_list.payloads])
+    key_lengths, key_data = encode_strings(keys)
+    string_lengths, string_data = encode_strings(strings)
+
+    parts = [
+        HEADER.pack(MAGIC, ITEM_SIZES, len(display_list), len(keys), len(strings),
+                    len(index.short), len(index.tall), index.max_height, index.bottom),
+        key_lengths.tobytes(), key_data, string_lengths.tobytes(), string_data,
+        display_list.kinds.tobytes(), display_list.lefts.tobytes(), display_list.tops.tobytes(),
+        display_list.rights.tobytes(), display_list.bottoms.tobytes(),
+        array("i", [font_map[i] for i in display_list.font_ids]).tobytes(),
+        payloads.tobytes(), index.short.tobytes(), index.tall.tobytes(), index.tops.tobytes(),
+    ]
+    return b"".join(parts)
+
+def decode(data):
+    # inverse of encode; returns (display_list, index), or None if the
+    # snapshot was written by an incompatible build
+    magic, item_sizes, rows, n_keys, n_strings, n_short, n_tall, max_height, bottom = \
+        HEADER.unpack_from(data)
+    if magic != MAGIC or item_sizes != ITEM_SIZES:
+        return None
+    view = memoryview(data)
+    pos = HEADER.size
+
+    def take(code, count):
+        nonlocal pos
+        values = array(code)
+        size = values.itemsize * count
+        values.frombytes(view[pos:pos + size])
+        pos += size
+        return values
+
+    def take_bytes(size):
+        nonlocal pos
+        pos += size
+        return data[pos - size:pos]
+
+    key_lengths = take("I", n_keys)
+    keys = decode_strings(key_lengths, take_bytes(sum(key_lengths)))
+    string_lengths = take("I", n_strings)
+    strings = decode_strings(string_lengths, take_bytes(sum(string_lengths)))
+
+    display_list = DisplayList(FONT_TABLE)
+    display_list.kinds = take("b", rows)
+    display_list.lefts = take("d", rows)
+    display_list.tops = take("d", rows)
+    display_list.rights = take("d", rows)
+    display_list.bottoms = take("d", rows)
+    font_ids = take("i", rows)
+    payloads = take("I", rows)
+    display_list.payloads = [strings[i] for i in payloads]
+
+    # snapshot font numbers -> this process's font ids
+    local = []
+    for key in keys:
+        family, size, weight, style = key.split("\0")
+        local.append(get_font_id((family, int(size), weight, style)))
+    if local != list(range(len(local))):
+        local.append(-1)
+        font_ids = array("i", [local[i] for i in font_ids])
+    display_list.font_ids = font_ids
+
+    index = DisplayIndex.from_arrays(display_list, take("l", n_short), take("l", n_tall),
+                                     take("d", n_short), max_height, bottom)
+    return display_list, index
+
+class SnapshotCache(LRU):
+    # laid-out display lists keyed by (body hash, width, font backend), held
+    # encoded in memory and written compressed to a directory, one file each
+    def __init__(self, capacity = MEMORY_SNAPSHOT_SIZE, disk_path = DISK_SNAPSHOT_PATH,
+                 disk_capacity = DISK_SNAPSHOT_SIZE):
+        super().__init__(capacity)
+        self.disk_path = disk_path
+        self.disk_capacity = disk_capacity
+        self.lock = threading.Lock()
+
+    def sizeof(self, data):
+        return len(data)
+
+    def path(self, key):
+        return os.path.join(self.disk_path, key + ".snap")
+
+    def get(self, key):
+        with self.lock:
+            data = self.recall(key)
+            if data is None:
+                data = self.read(key)
+                if data is not None:
+                    self.remember(key, data)
+        snapshot = decode(data) if data is not None else None
+        with self.lock:
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        tracer.count("snapshot hits" if snapshot else "snapshot misses")
+        return snapshot
+
+    def put(self, key, display_list, index):
+        data = encode(display_list, index)
+        with self.lock:
+            self.remember(key, data)
+            self.write(key, data)
+
+    def read(self, key):
+        if not self.disk_path:
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                data = zlib.decompress(f.read())
+            # bump the file's times so trimming treats it as recently used
+            os.utime(self.path(key))
+            return data
+        except (OSError, zlib.error):
+            return None
+
+    def write(self, key, data):
+        if not self.disk_path:
+            return
+        try:
+            os.makedirs(self.disk_path, exist_ok = True)
+            temp = self.path(key) + ".tmp"
+            with open(temp, "wb") as f:
+                f.write(zlib.compress(data, 1))
+            os.replace(temp, self.path(key))
+            self.trim()
+        except OSError:
+            # a read-only or full disk just means memory only
+            self.disk_path = None
+
+    def trim(self):
+        # drop the least recently used files until we're back under capacity
+        files = []
+        for entry in os.scandir(self.disk_path):
+            if entry.name.endswith(".snap"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_capacity:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+
+layout_snapshots = SnapshotCache()
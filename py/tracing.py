@@ -0,0 +1,98 @@
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+# returned by Tracer.span when tracing is off, so the with-statement costs nothing
+NO_SPAN = contextlib.nullcontext()
+
+class Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, self.tracer.now() - self.start, self.args)
+
+class Tracer:
+    # per-phase wall time and counters for the load pipeline, written out in
+    # Chrome trace format (load the file in chrome://tracing or Perfetto)
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []
+        self.counters = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def enable(self, path):
+        if not self.enabled:
+            atexit.register(self.write)
+        self.enabled = True
+        self.path = path
+
+    def now(self):
+        # microseconds since the tracer was created
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def complete(self, name, start, duration, args):
+        event = {
+            "name": name, "ph": "X", "ts": start, "dur": duration,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+            self.totals[name] = self.totals.get(name, 0) + duration
+
+    def count(self, name, n = 1):
+        if not self.enabled: return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        # record the counters as they stand, so the viewer can graph them over time
+        if not self.enabled: return
+        with self.lock:
+            self.events.append({
+                "name": "counters", "ph": "C", "ts": self.now(),
+                "pid": os.getpid(), "tid": threading.get_ident(),
+                "args": dict(self.counters),
+            })
+
+    def summary(self):
+        lines = ["{:>24}: {:10.1f} ms".format(name, total / 1000)
+                 for name, total in sorted(self.totals.items())]
+        lines += ["{:>24}: {:10d}".format(name, value)
+                  for name, value in sorted(self.counters.items())]
+        return "\n".join(lines)
+
+    def write(self):
+        if not self.enabled: return
+        self.snapshot()
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(self.path, "w") as f:
+            json.dump(trace, f)
+        print(self.summary(), file = sys.stderr)
+
+tracer = Tracer()
+
+# BROWSER_TRACE=trace.json turns tracing on for the whole run
+if os.environ.get("BROWSER_TRACE"):
+    tracer.enable(os.environ["BROWSER_TRACE"])
@@ -1,10 +1,214 @@
 import socket
 import ssl
 import time
-from typing import Dict, Tuple
-import gzip
+import zlib
+import codecs
+import threading
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ResponseCache, CachePolicy
+from tracing import tracer
+
+response_cache = ResponseCache()
+
+# headers sent with every request, also used to match cached responses that Vary
+REQUEST_HEADERS = {
+    "user-agent": "archermarx",
+    "accept-encoding": "gzip, deflate",
+}
+
+# size of the reads used to stream a content-length body
+READ_SIZE = 64 * 1024
+
+# keep-alive connection pool limits
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30.0
+# blocking socket operations give up after this long
+SOCKET_TIMEOUT = 30.0
+# and so does waiting for a free connection to a busy host
+ACQUIRE_TIMEOUT = 30.0
+
+# limits for the asyncio fetch API; FETCH_TIMEOUT bounds a whole prefetch,
+# while a page's own request only has SOCKET_TIMEOUT between reads
+MAX_FETCHES_PER_HOST = MAX_CONNECTIONS_PER_HOST
+FETCH_TIMEOUT = 30.0
+
+class Connection:
+    def __init__(self, key, sock):
+        self.key = key
+        self.socket = sock
+        self.file = sock.makefile("rb")
+        self.reused = False
+        self.idle_since = None
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+class ConnectionPool:
+    # keep-alive sockets keyed by (scheme, host, port), plus the shared
+    # SSL context and the last TLS session for each host so reconnects can
+    # resume instead of doing a full handshake
+    def __init__(self, max_per_host = MAX_CONNECTIONS_PER_HOST, idle_timeout = IDLE_TIMEOUT,
+                 acquire_timeout = ACQUIRE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.idle = {}
+        self.open = {}
+        self.tls_sessions = {}
+        self.ssl_context = None
+        self.lock = threading.Condition()
+
+    def acquire(self, scheme, host, port):
+        key = (scheme, host, port)
+        deadline = time.monotonic() + self.acquire_timeout
+        with self.lock:
+            while True:
+                self.prune()
+                idle = self.idle.get(key)
+                if idle:
+                    connection = idle.pop()
+                    connection.reused = True
+                    return connection
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                # wait for another request to hand a connection back
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    raise TimeoutError("no free connection to {}".format(host))
+
+        try:
+            return self.connect(key)
+        except:
+            with self.lock:
+                self.open[key] -= 1
+                self.lock.notify_all()
+            raise
+
+    def connect(self, key):
+        scheme, host, port = key
+        sock = socket.socket(
+            family = socket.AF_INET,
+            type = socket.SOCK_STREAM,
+            proto = socket.IPPROTO_TCP,
+        )
+        try:
+            sock.settimeout(SOCKET_TIMEOUT)
+            sock.connect((host, port))
+
+            # wrap socket with SSL encryption if using https
+            if scheme == "https":
+                sock = self.context().wrap_socket(
+                    sock, server_hostname = host,
+                    session = self.tls_sessions.get(key))
+        except:
+            sock.close()
+            raise
+        return Connection(key, sock)
+
+    def context(self):
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        return self.ssl_context
+
+    def release(self, connection, reusable):
+        with self.lock:
+            if isinstance(connection.socket, ssl.SSLSocket) and connection.socket.session:
+                self.tls_sessions[connection.key] = connection.socket.session
+            if reusable:
+                connection.idle_since = time.monotonic()
+                self.idle.setdefault(connection.key, []).append(connection)
+            else:
+                connection.close()
+                self.open[connection.key] -= 1
+            self.lock.notify_all()
+
+    def prune(self):
+        # close connections that have sat idle longer than the timeout
+        now = time.monotonic()
+        for key, idle in self.idle.items():
+            while idle and now - idle[0].idle_since > self.idle_timeout:
+                idle.pop(0).close()
+                self.open[key] -= 1
+
+    def close_all(self):
+        with self.lock:
+            for key, idle in self.idle.items():
+                for connection in idle:
+                    connection.close()
+                self.open[key] -= len(idle)
+            self.idle = {}
+            self.lock.notify_all()
+
+connection_pool = ConnectionPool()
+
+class DeflateDecompressor:
+    # "deflate" is meant to be zlib-wrapped, but plenty of servers send raw
+    # deflate data, so look at the first bytes before picking a format
+    def __init__(self):
+        self.decompressor = None
+        self.pending = b""
+
+    def decompress(self, data):
+        if self.decompressor is None:
+            self.pending += data
+            if len(self.pending) < 2:
+                return b""
+            header = self.pending[0] << 8 | self.pending[1]
+            zlib_wrapped = self.pending[0] & 0x0f == 8 and header % 31 == 0
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS if zlib_wrapped else -zlib.MAX_WBITS)
+            data, self.pending = self.pending, b""
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        if self.decompressor is None:
+            return b""
+        return self.decompressor.flush()
+
+DECOMPRESSORS = {
+    "gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    "x-gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    "deflate": DeflateDecompressor,
+}
+
+def charset(content_type, default = "utf-8"):
+    # pull the charset parameter out of a content type, if python knows it
+    for param in content_type.split(";")[1:]:
+        if "=" not in param: continue
+        name, value = param.split("=", 1)
+        if name.strip().casefold() == "charset":
+            value = value.strip().strip('"\'')
+            try:
+                return codecs.lookup(value).name
+            except LookupError:
+                break
+    return default
+
+# per-event-loop semaphores keyed by (scheme, host, port)
+host_limits = weakref.WeakKeyDictionary()
+
+# blocking requests run here rather than on the default executor, which can be
+# smaller than the number of fetches we want in flight
+fetch_executor = ThreadPoolExecutor(max_workers = 4 * MAX_FETCHES_PER_HOST)
+
+def host_limit(url):
+    limits = host_limits.setdefault(asyncio.get_running_loop(), {})
+    key = (url.scheme, getattr(url, "host", None), getattr(url, "port", None))
+    if key not in limits:
+        limits[key] = asyncio.Semaphore(MAX_FETCHES_PER_HOST)
+    return limits[key]
+
+async def fetch_many(urls, timeout = FETCH_TIMEOUT):
+    # fetch several URLs concurrently; failures come back as exception objects
+    urls = [url if isinstance(url, URL) else URL(url) for url in urls]
+    return await asyncio.gather(
+        *[url.request_async(timeout = timeout) for url in urls],
+        return_exceptions = True)
 
-response_cache: Dict[str, Tuple[float, float, str]] = {}
 class URL:
     
     def url_check(self, cond):
@@ -15,10 +219,17 @@ class URL:
         # store initial url to use a as a key for cache lookups
         self.url = url
         self.malformed = False
+        # set when the body is handed over in one piece (file, data or cached
+        # responses) rather than streamed as it arrives
+        self.whole_body = False
 
         # prevent infinite redirect chains
         self.redirect_depth = redirect_depth
 
+        # set by cancel() to stop a request running on another thread;
+        # shared with the URLs it redirects to
+        self.cancelled = threading.Event()
+
         # set default content type
         self.content_type = "text/html"
 
@@ -68,7 +279,7 @@ class URL:
         # determine which port we're using
         if ":" in self.host:
             # custom port present
-            self.host, port = url.split(":", 1)
+            self.host, port = self.host.split(":", 1)
             self.port = int(port)
         elif self.scheme == "http":
             self.port = 80
@@ -77,145 +288,293 @@ class URL:
 
         self.socket = None
 
-    def request(self):
+    def request(self, on_data = None):
+        # if on_data is given, the decoded body is also handed to it piece by
+        # piece as it arrives, and is only kept in memory if it gets cached
+        with tracer.span("fetch", url = self.url):
+            return self.fetch(on_data)
+
+    def fetch(self, on_data):
         if self.malformed:
-            return "", None, None
+            return self.deliver("", on_data), None, None
 
         if self.scheme == "data":
-            return self.data, None, None
+            return self.deliver(self.data, on_data), None, None
 
         if self.scheme == "file":
             with open(self.path) as f:
-                return f.read(), None, None
+                return self.deliver(f.read(), on_data), None, None
 
         current_time = time.time()
-            
-        if self.url in response_cache:
+
+        entry = response_cache.lookup(self.url, REQUEST_HEADERS)
+        if entry and entry.fresh(current_time):
             # use cached response if page not too old
-            content = response_cache[self.url]
-            timestamp, max_age, content = response_cache[self.url]
-            age = current_time - timestamp
-            if (max_age < 0) or (age < max_age):
-                return content, True, max_age
-      
-        #  Create socket
-        self.socket = socket.socket(
-            family = socket.AF_INET,
-            type = socket.SOCK_STREAM,
-            proto = socket.IPPROTO_TCP,
-        )
+            tracer.count("response cache hits")
+            self.content_type = entry.content_type
+            return self.deliver(entry.content(), on_data), True, entry.max_age
 
-        try:
-            self.socket.connect((self.host, self.port))
-        except:
-            return "Invalid URL", None, None
-        
-        # wrap socket with SSL encryption if using https
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            self.socket = ctx.wrap_socket(self.socket, server_hostname = self.host)
-
-        # send HTTP GET request
-        request = f"GET {self.path} HTTP/1.1\r\n"
-        request += f"Host: {self.host}\r\n"
-        request += "User-Agent: archermarx\r\n"
-        request += "Connection: close\r\n"
-        request += "Accept-Encoding: gzip\r\n"
-        request += "\r\n"
-        self.socket.send(request.encode("utf8"))            
-        
-        response = self.socket.makefile("rb", newline = "\r\n")
+        tracer.count("response cache misses")
+        # a stale entry with validators lets the server answer 304 instead of resending the body
+        validators = entry.validators() if entry else {}
 
-        # Parse the response
-        statusline = response.readline().decode("utf8")
-        version, status, explanation = statusline.split(" ", 2)
-        status = int(status)
+        try:
+            connection, version, status, response_headers = self.send_request(validators)
+        except OSError:
+            return self.deliver("Invalid URL", on_data), None, None
+        # the connection goes back to the pool exactly once, however we leave
+        released = False
+
+        def hand_back(reusable):
+            nonlocal released
+            released = True
+            # so cancel() can't shut down a socket another request now owns
+            self.socket = None
+            connection_pool.release(connection, reusable)
 
-        response_headers = {}
-        while True:
-            line = response.readline().decode("utf8")
-            if line == "\r\n": 
-                break
-            header, value = line.split(":", 1)
-            response_headers[header.casefold()] = value.strip()
-
-        max_age = -1.0
-        cache = True
-
-        if "cache-control" in response_headers:
-            options = response_headers["cache-control"].split(",")
-            for opt in options:
-                opt = opt.strip()
-                if opt == "no-store":
-                    cache = False
-                elif opt.startswith("max-age"):
-                    _, val = opt.split("=", 1)
-                    max_age = float(val)
-                else:
-                    # don't cache if other options provided
-                    cache = False
-            
-        # don't bother caching pages with very short max ages
-        if max_age < 1.0:
-            cache = False
-
-        # check for redirect
-        if 300 <= status < 400 and self.redirect_depth < 10:
-            location = response_headers["location"]
-            if location.startswith("/"):
-                location = self.scheme + "://" + self.host + location
+        try:
+            return self.read_response(connection, version, status, response_headers,
+                                      entry, on_data, current_time, hand_back)
+        except BaseException:
+            if not released:
+                hand_back(False)
+            raise
 
-            print(f"Redirecting to {location} (depth = {self.redirect_depth})")
-            redirect = URL(location, self.redirect_depth + 1)
-            # todo: cache redirects without caching whole page
-            return redirect.request()
+    def read_response(self, connection, version, status, response_headers,
+                      entry, on_data, current_time, hand_back):
+        response = connection.file
 
-        self.content_type = response_headers["content-type"]
+        policy = CachePolicy(response_headers)
+        cache = policy.store
+        max_age = policy.max_age
 
         chunked = False
-        compressed = False
+        # codings in the order they were applied; undone last to first
+        encodings = []
+
+        if "content-encoding" in response_headers:
+            content_encoding_opts = [s.strip().casefold() for s in response_headers["content-encoding"].split(",")]
+            encodings += [opt for opt in content_encoding_opts if opt in DECOMPRESSORS]
 
         if "transfer-encoding" in response_headers:
-            transfer_encoding_opts = [s.strip() for s in response_headers["transfer-encoding"].split(",")]
+            transfer_encoding_opts = [s.strip().casefold() for s in response_headers["transfer-encoding"].split(",")]
             chunked = "chunked" in transfer_encoding_opts
-            compressed = "gzip" in transfer_encoding_opts
+            encodings += [opt for opt in transfer_encoding_opts if opt in DECOMPRESSORS]
 
-        if "content-encoding" in response_headers:
-            content_encoding_opts = [s.strip() for s in response_headers["content-encoding"].split(",")]
-            compressed = "gzip" in content_encoding_opts
+        # the connection can only go back to the pool if we know where the body ends
+        # and the server hasn't asked us to hang up
+        no_body = status in (204, 304)
+        reusable = version == "HTTP/1.1" and \
+            response_headers.get("connection", "").casefold() != "close" and \
+            (no_body or chunked or "content-length" in response_headers)
 
         def read_chunk(f):
             chunk = b""
             chunk_size = f.readline()
-            chunk_size = int(chunk_size[:-2], 16)
+            chunk_size = int(chunk_size.split(b";", 1)[0], 16)
             if chunk_size > 0:
                 chunk += f.read(chunk_size)
                 f.readline()
+            else:
+                # skip any trailers up to the blank line ending the body
+                while f.readline() not in (b"\r\n", b"\n", b""):
+                    pass
             return chunk
 
-        # read content in chunks if requested
-        if chunked:
-            content = b""
-            while True:
-                chunk = read_chunk(response)
-                if not chunk:
-                    break
-                content += chunk
-
-        else:
-            bytes_to_read = int(response_headers["content-length"])
-            content = response.read(bytes_to_read)
+        def read_body(f):
+            # yield the raw body in pieces as they come off the socket
+            if no_body:
+                return
+            elif chunked:
+                while True:
+                    chunk = read_chunk(f)
+                    if not chunk:
+                        break
+                    yield chunk
+            elif "content-length" in response_headers:
+                bytes_to_read = int(response_headers["content-length"])
+                while bytes_to_read > 0:
+                    chunk = f.read(min(bytes_to_read, READ_SIZE))
+                    if not chunk:
+                        raise ConnectionError("connection closed mid-body")
+                    bytes_to_read -= len(chunk)
+                    yield chunk
+            else:
+                # no framing -- the body runs until the server closes the connection
+                while True:
+                    chunk = f.read1(READ_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        # the cached copy is still good
+        if status == 304 and entry:
+            tracer.count("response cache revalidations")
+            hand_back(reusable)
+            response_cache.refresh(entry, policy, current_time)
+            self.content_type = entry.content_type
+            return self.deliver(entry.content(), on_data), True, entry.max_age
+
+        # check for redirect; a 304 we can't use or a 3xx without a Location
+        # falls through and is shown as it is
+        if 300 <= status < 400 and status != 304 and "location" in response_headers and \
+                self.redirect_depth < 10:
+            location = response_headers["location"]
+            if location.startswith("/"):
+                location = self.origin() + location
 
-        # decompress content if needed
-        if compressed:
-            content = gzip.decompress(content)
+            # drain the body so the connection can serve the next hop
+            try:
+                for _ in read_body(response): pass
+            except OSError:
+                reusable = False
+            hand_back(reusable)
 
-        content = content.decode("utf-8")
+            print(f"Redirecting to {location} (depth = {self.redirect_depth})")
+            redirect = URL(location, self.redirect_depth + 1)
+            redirect.cancelled = self.cancelled
+            # todo: cache redirects without caching whole page
+            return redirect.request(on_data)
+
+        self.content_type = response_headers.get("content-type", "text/html")
+
+        keep = cache or on_data is None
+        pieces = []
+
+        def emit(text):
+            if not text: return
+            if keep: pieces.append(text)
+            if on_data: on_data(text)
+
+        # decompress and decode as the data arrives so we never hold more than
+        # one copy of the body
+        decompressors = [DECOMPRESSORS[coding]() for coding in reversed(encodings)]
+        decoder = codecs.getincrementaldecoder(charset(self.content_type))(errors = "replace")
+
+        for chunk in read_body(response):
+            if self.cancelled.is_set():
+                raise ConnectionAbortedError("request cancelled")
+            tracer.count("bytes fetched", len(chunk))
+            for decompressor in decompressors:
+                chunk = decompressor.decompress(chunk)
+            emit(decoder.decode(chunk))
+        for i, decompressor in enumerate(decompressors):
+            # push anything still buffered through the remaining stages
+            chunk = decompressor.flush()
+            for later in decompressors[i + 1:]:
+                chunk = later.decompress(chunk)
+            emit(decoder.decode(chunk))
+        emit(decoder.decode(b"", final = True))
+        hand_back(reusable)
+
+        content = "".join(pieces)
 
         # cache content
         if cache and (status == 200 or status == 404):
-            response_cache[self.url] = (current_time, max_age, content)
-
-        self.socket.close()
+            response_cache.put(self.url, status, self.content_type, policy,
+                               REQUEST_HEADERS, content, current_time)
 
         return content, cache, max_age
+
+    def origin(self):
+        default_port = 443 if self.scheme == "https" else 80
+        if self.port == default_port:
+            return self.scheme + "://" + self.host
+        return f"{self.scheme}://{self.host}:{self.port}"
+
+    def send_request(self, extra_headers = {}):
+        # send a GET on a pooled connection; an idle keep-alive connection may
+        # have been closed by the server, in which case try again on a new one
+        while True:
+            connection = connection_pool.acquire(self.scheme, self.host, self.port)
+            self.socket = connection.socket
+            try:
+                if self.cancelled.is_set():
+                    raise ConnectionAbortedError("request cancelled")
+                request = f"GET {self.path} HTTP/1.1\r\n"
+                request += f"Host: {self.host}\r\n"
+                request += "Connection: keep-alive\r\n"
+                for header, value in {**REQUEST_HEADERS, **extra_headers}.items():
+                    request += f"{header.title()}: {value}\r\n"
+                request += "\r\n"
+                self.socket.sendall(request.encode("utf8"))
+
+                response = connection.file
+
+                # Parse the response
+                statusline = response.readline().decode("utf8")
+                if not statusline:
+                    raise ConnectionError("connection closed before response")
+                version, status, explanation = statusline.split(" ", 2)
+                status = int(status)
+
+                response_headers = {}
+                while True:
+                    line = response.readline().decode("utf8")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    header, value = line.split(":", 1)
+                    response_headers[header.casefold()] = value.strip()
+            except OSError:
+                connection_pool.release(connection, False)
+                if connection.reused and not self.cancelled.is_set():
+                    continue
+                raise
+            except BaseException:
+                # a malformed response; don't let it keep the slot in the pool
+                connection_pool.release(connection, False)
+                raise
+
+            return connection, version, status, response_headers
+
+    async def request_async(self, on_data = None, timeout = None):
+        # the blocking request runs on a worker thread so the event loop stays
+        # free; the semaphore keeps us from queueing up on the connection pool
+        async with host_limit(self):
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(fetch_executor, self.request, on_data)
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # the thread keeps its connection until it notices, so stop
+                # it and wait for that before giving up our place
+                self.cancel()
+                await asyncio.wait([future])
+                if not future.cancelled():
+                    future.exception()
+                raise
+
+    def cancel(self):
+        # make a request running on another thread fail soon: the read loop
+        # checks the flag, and shutting the socket down wakes a blocked read.
+        # The failed request closes its connection rather than pooling it.
+        self.cancelled.set()
+        sock = getattr(self, "socket", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def resolve(self, href):
+        # turn a link found in this page into an absolute URL
+        if "://" in href or href.startswith("data:"):
+            return href
+        if self.scheme not in ("http", "https"):
+            return href
+        if href.startswith("//"):
+            return self.scheme + ":" + href
+        if not href.startswith("/"):
+            directory, _ = self.path.rsplit("/", 1)
+            while href.startswith("../"):
+                _, href = href.split("/", 1)
+                if "/" in directory:
+                    directory, _ = directory.rsplit("/", 1)
+            href = directory + "/" + href
+        return self.origin() + href
+
+    def deliver(self, content, on_data):
+        self.whole_body = True
+        if on_data and content:
+            on_data(content)
+        return content